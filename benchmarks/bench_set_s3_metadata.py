@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Benchmarks set_s3_metadata.replace_metadata against a
+# local moto S3 server, comparing a new boto3 client per
+# key (the old behaviour) with one shared client.
+#
+# Requires moto[server].
+#-------------------------------------------------------
+import logging
+from optparse import OptionParser
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import set_s3_metadata
+from servers import start_moto
+
+BUCKET = "bench-tiles"
+
+
+def _populate(count):
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket=BUCKET)
+    keys = ["tiles/%d/%d.png" % (i // 1000, i % 1000) for i in range(count)]
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"png", ContentType="image/png")
+    return keys
+
+
+def _run(keys, threads, metadata, client_factory):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda key: set_s3_metadata.replace_metadata(
+            BUCKET, key, metadata, s3=client_factory()), keys))
+    return len(keys) / (time.perf_counter() - start)
+
+
+def run(count, threads, port):
+    server = start_moto(port)
+    try:
+        keys = _populate(count)
+        metadata = {"Cache-Control": "max-age=3600"}
+        shared = boto3.client("s3", config=Config(max_pool_connections=threads))
+
+        per_key = _run(keys, threads, metadata, lambda: boto3.client("s3"))
+        reused = _run(keys, threads, metadata, lambda: shared)
+        print("%d objects, %d threads" % (count, threads))
+        print("client per key: %8.1f objects/s" % per_key)
+        print("shared client:  %8.1f objects/s (%.1fx)" % (reused, reused / per_key))
+        return {"client_per_key": per_key, "shared_client": reused}
+    finally:
+        server.stop()
+
+
+def _main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage,
+                          description="Benchmark set_s3_metadata.replace_metadata against moto")
+    parser.add_option("-n", "--objects", action="store", type="int", dest="objects", default=2000)
+    parser.add_option("-t", "--threads", action="store", type="int", dest="threads", default=16)
+    parser.add_option("-p", "--port", action="store", type="int", dest="port", default=5123)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    run(options.objects, options.threads, options.port)
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Compares the scalar and NumPy array tile math in
+# tilenames.py: checks that they agree point for point,
+# on random points and on points at and one bit either
+# side of tile edges, and reports points/s for each.
+#-------------------------------------------------------
+import logging
+from optparse import OptionParser
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tilenames
+
+
+def _random_points(count, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(-85.0511, 85.0511, count)
+    lon = rng.uniform(-180, 180, count)
+    return lat, lon
+
+
+def _boundary_points(zoom, count):
+    """
+    Up to count tile edge latitudes and longitudes at zoom, each also one
+    bit above and below, paired with random points on the other axis.
+    """
+    n = 1 << zoom
+    step = max(1, (n + 1) * 3 // count)
+    edge_lat = np.array([tilenames.latEdges(y, zoom)[0] for y in range(0, n + 1, step)])
+    edge_lon = np.array([tilenames.lonEdges(x, zoom)[0] for x in range(0, n + 1, step)])
+    edge_lat = np.concatenate((edge_lat, np.nextafter(edge_lat, 90), np.nextafter(edge_lat, -90)))
+    edge_lon = np.concatenate((edge_lon, np.nextafter(edge_lon, 180), np.nextafter(edge_lon, -180)))
+    edge_lat = edge_lat[np.abs(edge_lat) <= tilenames.MAX_LAT]
+    edge_lon = edge_lon[np.abs(edge_lon) <= 180]
+    rand_lat, rand_lon = _random_points(len(edge_lat) + len(edge_lon), seed=1)
+    lat = np.concatenate((edge_lat, rand_lat[len(edge_lat):]))
+    lon = np.concatenate((rand_lon[:len(edge_lat)], edge_lon))
+    return lat, lon
+
+
+def _tile_mismatches(lat, lon, zoom):
+    xs, ys = tilenames.tileXYArray(lat, lon, zoom)
+    return sum(1 for a, b, x, y in zip(lat.tolist(), lon.tolist(), xs.tolist(), ys.tolist())
+        if tilenames.tileXY(a, b, zoom) != (x, y))
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def run(count, zoom):
+    lat, lon = _random_points(count)
+
+    def scalar_tiles():
+        return [tilenames.tileXY(a, b, zoom) for a, b in zip(lat.tolist(), lon.tolist())]
+
+    scalar, scalar_time = _timed(scalar_tiles)
+    (xs, ys), array_time = _timed(tilenames.tileXYArray, lat, lon, zoom)
+    mismatches = sum(1 for (x, y), ax, ay in zip(scalar, xs.tolist(), ys.tolist()) if (x, y) != (ax, ay))
+
+    def scalar_edges():
+        return [tilenames.tileEdges(x, y, zoom) for x, y in scalar]
+
+    edges, scalar_edges_time = _timed(scalar_edges)
+    array_edges, array_edges_time = _timed(tilenames.tileEdgesArray, xs, ys, zoom)
+    edge_error = float(np.max(np.abs(np.array(edges).T - np.array(array_edges))))
+
+    def scalar_quadkeys():
+        return [tilenames.tile2quadkey(x, y, zoom) for x, y in scalar]
+
+    quadkeys, scalar_qk_time = _timed(scalar_quadkeys)
+    array_quadkeys, array_qk_time = _timed(tilenames.tile2quadkeyArray, xs, ys, zoom)
+    qk_mismatches = sum(1 for a, b in zip(quadkeys, array_quadkeys.tolist()) if a.encode() != b)
+
+    edge_lat, edge_lon = _boundary_points(zoom, count)
+    edge_mismatches = _tile_mismatches(edge_lat, edge_lon, zoom)
+
+    print("%d points at zoom %d" % (count, zoom))
+    print("tileXY:     scalar %10.0f points/s, array %12.0f points/s, %.1fx, %d mismatches" % (
+        count / scalar_time, count / array_time, scalar_time / array_time, mismatches))
+    print("tileEdges:  scalar %10.0f tiles/s,  array %12.0f tiles/s,  %.1fx, max error %g" % (
+        count / scalar_edges_time, count / array_edges_time, scalar_edges_time / array_edges_time, edge_error))
+    print("quadkey:    scalar %10.0f tiles/s,  array %12.0f tiles/s,  %.1fx, %d mismatches" % (
+        count / scalar_qk_time, count / array_qk_time, scalar_qk_time / array_qk_time, qk_mismatches))
+    print("tileXY at tile edges: %d points, %d mismatches" % (len(edge_lat), edge_mismatches))
+
+
+def _main():
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage,
+                          description="Benchmark scalar vs array tile math in tilenames.py")
+    parser.add_option("-n", "--points", action="store", type="int", dest="points", default=1000000)
+    parser.add_option("-z", "--zoom", action="store", type="int", dest="zoom", default=15)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    run(options.points, options.zoom)
+
+if __name__ == "__main__":
+    _main()
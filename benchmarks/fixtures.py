@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Generated input files for the benchmarks: a GeoPackage
+# of points with low and high cardinality string fields
+# and numeric fields, a tiled GeoTIFF with overviews, and
+# line-delimited GeoJSON with HTML entities to strip.
+#
+# The GeoPackage needs the GDAL Python bindings; the
+# GeoTIFF uses rasterio if available, otherwise GDAL.
+#-------------------------------------------------------
+import json
+import random
+
+KINDS = ["residential", "commercial", "industrial", "park", "water", "forest", "farmland"]
+
+
+def make_geopackage(path, features, seed=0):
+    """Write features random points to layer 'places' of a new GeoPackage."""
+    from osgeo import ogr, osr
+    ogr.UseExceptions()
+
+    rng = random.Random(seed)
+    driver = ogr.GetDriverByName("GPKG")
+    source = driver.CreateDataSource(path)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    layer = source.CreateLayer("places", srs, ogr.wkbPoint)
+    for name, field_type in (("name", ogr.OFTString), ("kind", ogr.OFTString),
+            ("population", ogr.OFTInteger), ("area", ogr.OFTReal)):
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+    defn = layer.GetLayerDefn()
+
+    layer.StartTransaction()
+    for i in range(features):
+        feature = ogr.Feature(defn)
+        feature.SetField("name", "place %d" % rng.randint(0, features // 2))
+        feature.SetField("kind", rng.choice(KINDS))
+        feature.SetField("population", rng.randint(0, 100000))
+        feature.SetField("area", rng.expovariate(0.01))
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(rng.uniform(-180, 180), rng.uniform(-85, 85))
+        feature.SetGeometry(point)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+    source = None
+    return path
+
+
+def make_geotiff(path, width, height, overviews=(2, 4, 8, 16), seed=0):
+    """Write a tiled single-band uint8 GeoTIFF in EPSG:3857 with overviews."""
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    ## smooth gradients plus noise, so overviews are not trivially constant
+    data = ((np.add.outer(np.arange(height) // 7, np.arange(width) // 11) % 255)
+        + rng.integers(0, 16, (height, width))).astype("uint8")
+    transform = (-20037508.34, 10.0, 0.0, 20037508.34, 0.0, -10.0)
+    try:
+        import rasterio
+        from rasterio.transform import Affine
+    except ImportError:
+        rasterio = None
+
+    if rasterio is not None:
+        with rasterio.open(path, "w", driver="GTiff", width=width, height=height, count=1,
+                dtype="uint8", crs="EPSG:3857", transform=Affine.from_gdal(*transform),
+                tiled=True, blockxsize=256, blockysize=256) as dst:
+            dst.write(data, 1)
+            if overviews:
+                dst.build_overviews(list(overviews))
+    else:
+        from osgeo import gdal, osr
+        gdal.UseExceptions()
+        dst = gdal.GetDriverByName("GTiff").Create(path, width, height, 1, gdal.GDT_Byte,
+            options=["TILED=YES"])
+        dst.SetGeoTransform(transform)
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3857)
+        dst.SetProjection(srs.ExportToWkt())
+        dst.GetRasterBand(1).WriteArray(data)
+        if overviews:
+            dst.BuildOverviews("NEAREST", list(overviews))
+        dst = None
+    return path
+
+
+def make_geojson(path, features, seed=0):
+    """Write features points as line-delimited GeoJSON, some with entities and newlines."""
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(features):
+            name = "place %d" % rng.randint(0, features // 2)
+            if i % 3 == 0:
+                name = "Caf&eacute; &amp; %s\n" % name
+            properties = {"name": name, "kind": rng.choice(KINDS + [None]),
+                "population": rng.randint(0, 100000), "area": rng.expovariate(0.01)}
+            geometry = {"type": "Point",
+                "coordinates": [rng.uniform(-180, 180), rng.uniform(-85, 85)]}
+            f.write(json.dumps({"type": "Feature", "properties": properties,
+                "geometry": geometry}) + "\n")
+    return path
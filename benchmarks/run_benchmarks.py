@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Benchmark harness for the tiling tools.
+#
+# Each benchmark runs in its own process against local
+# stand-ins (servers.py) and generated fixtures
+# (fixtures.py), and reports its throughput and peak RSS.
+# Results are written as JSON so runs can be compared with
+# --compare. Benchmarks whose dependencies are missing are
+# recorded as skipped.
+#-------------------------------------------------------
+import importlib.util
+import json
+import logging
+from optparse import OptionParser
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from queue import Empty
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCH_DIR, "..")
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fixtures
+import servers
+
+S3_BUCKET = "bench-tiles"
+## bbox of western Europe, about 1,400 tiles from z0 to z8
+DOWNLOAD_BBOX = (-10.0, 35.0, 20.0, 60.0)
+
+
+class _NullProgress(object):
+    def update(self, n=1):
+        pass
+
+    def close(self):
+        pass
+
+
+def _rate(count, seconds):
+    return count / seconds if seconds else None
+
+
+def bench_download_tiles(tmp, options, output="tiles"):
+    import download_tiles
+
+    path = os.path.join(tmp, output)
+    tiles = sum(1 for _ in download_tiles._iter_tiles(0, options.max_zoom, DOWNLOAD_BBOX))
+    with servers.TileServer(latency=options.latency, jitter=options.latency / 2,
+            error_rate=options.error_rate) as server:
+        start = time.perf_counter()
+        download_tiles.download_tiles(0, options.max_zoom, DOWNLOAD_BBOX, server.url, path,
+            workers=options.workers, backoff=0.01)
+        seconds = time.perf_counter() - start
+        requests, errors = server.requests, server.errors
+    return {"tiles": tiles, "seconds": seconds, "tiles_per_s": _rate(tiles, seconds),
+        "requests": requests, "server_errors": errors}
+
+
+def bench_download_tiles_mbtiles(tmp, options):
+    return bench_download_tiles(tmp, options, output="tiles.mbtiles")
+
+
+def bench_set_s3_metadata(tmp, options):
+    import boto3
+    server = servers.start_moto(options.moto_port)
+    try:
+        import set_s3_metadata
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket=S3_BUCKET)
+        for i in range(options.objects):
+            s3.put_object(Bucket=S3_BUCKET, Key="tiles/%d/%d.png" % (i // 1000, i % 1000),
+                Body=b"png", ContentType="image/png")
+
+        client = set_s3_metadata._get_client(max_pool_connections=options.workers + 1)
+        pages = client.get_paginator("list_objects_v2").paginate(Bucket=S3_BUCKET, Prefix="tiles/")
+        start = time.perf_counter()
+        counts = set_s3_metadata.update_metadata(client, S3_BUCKET, pages,
+            {"Cache-Control": "max-age=3600"}, options.workers, progress=_NullProgress())
+        seconds = time.perf_counter() - start
+    finally:
+        server.stop()
+    return {"objects": options.objects, "seconds": seconds,
+        "objects_per_s": _rate(options.objects, seconds), "failed": counts["failed"]}
+
+
+def _bench_ogr_value_summary(tmp, options, approximate):
+    import ogr_value_summary
+    path = os.path.join(tmp, "places.gpkg")
+    if not os.path.exists(path):
+        fixtures.make_geopackage(path, options.features)
+    start = time.perf_counter()
+    ogr_value_summary.summarize_layer(path, 0, approximate=approximate)
+    seconds = time.perf_counter() - start
+    return {"features": options.features, "seconds": seconds,
+        "features_per_s": _rate(options.features, seconds)}
+
+
+def bench_ogr_value_summary(tmp, options):
+    return _bench_ogr_value_summary(tmp, options, approximate=False)
+
+
+def bench_ogr_value_summary_approximate(tmp, options):
+    return _bench_ogr_value_summary(tmp, options, approximate=True)
+
+
+def bench_plot_geotiff(tmp, options):
+    import matplotlib
+    matplotlib.use("Agg")
+    import rasterio
+    from rasterio import windows
+
+    spec = importlib.util.spec_from_file_location("plot_geotiff_pixel_bbox",
+        os.path.join(REPO_DIR, "plot-geotiff-pixel-bbox.py"))
+    plot = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plot)
+
+    path = fixtures.make_geotiff(os.path.join(tmp, "scene.tif"), options.raster_size, options.raster_size)
+    plots = 5
+    start = time.perf_counter()
+    with rasterio.open(path) as src:
+        for i in range(plots):
+            window = windows.Window(i * 100, i * 100, 300, 200)
+            fig = plot.plot_bbox(src, "scene.tif", window, dpi=100)
+            fig.savefig(os.path.join(tmp, "plot%d.png" % i), dpi=100)
+            plot.plt.close(fig)
+    seconds = time.perf_counter() - start
+    return {"plots": plots, "raster_size": options.raster_size, "seconds": seconds,
+        "plots_per_s": _rate(plots, seconds)}
+
+
+def bench_raster_extent(tmp, options):
+    import raster_extent
+    paths = [fixtures.make_geotiff(os.path.join(tmp, "r%d.tif" % i), 512, 512, overviews=())
+        for i in range(options.rasters)]
+    start = time.perf_counter()
+    count = sum(1 for _ in raster_extent.iter_footprints(paths))
+    seconds = time.perf_counter() - start
+    return {"rasters": count, "seconds": seconds, "rasters_per_s": _rate(count, seconds)}
+
+
+def bench_geojson_strip_html(tmp, options):
+    import geojson_strip_html
+    path = fixtures.make_geojson(os.path.join(tmp, "places.geojson"), options.features)
+    start = time.perf_counter()
+    geojson_strip_html.strip_html(path, os.path.join(tmp, "places-cleaned.geojson"),
+        summary_kwargs={})
+    seconds = time.perf_counter() - start
+    return {"features": options.features, "seconds": seconds,
+        "features_per_s": _rate(options.features, seconds)}
+
+
+BENCHMARKS = [
+    ("download_tiles", bench_download_tiles),
+    ("download_tiles_mbtiles", bench_download_tiles_mbtiles),
+    ("set_s3_metadata", bench_set_s3_metadata),
+    ("ogr_value_summary", bench_ogr_value_summary),
+    ("ogr_value_summary_approximate", bench_ogr_value_summary_approximate),
+    ("plot_geotiff", bench_plot_geotiff),
+    ("raster_extent", bench_raster_extent),
+    ("geojson_strip_html", bench_geojson_strip_html),
+]
+
+
+def _peak_rss_mb():
+    ## ru_maxrss is in KB on Linux; pools report through RUSAGE_CHILDREN
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == "darwin":
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+def _run_one(name, options, results):
+    logging.basicConfig(level=logging.ERROR)
+    func = dict(BENCHMARKS)[name]
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = func(tmp, options)
+        result["status"] = "ok"
+        result["peak_rss_mb"] = _peak_rss_mb()
+    except ImportError as e:
+        result = {"status": "skipped", "reason": str(e)}
+    except Exception as e:
+        result = {"status": "error", "reason": "%s: %s" % (type(e).__name__, e),
+            "traceback": traceback.format_exc()}
+    results.put(result)
+
+
+def run(names, options):
+    """Run each named benchmark in a fresh process; return {name: result}."""
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_one, args=(name, options, queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    result = {"status": "error",
+                        "reason": "benchmark process exited with %s" % process.exitcode}
+        process.join()
+        results[name] = result
+        logging.info("%-30s %s" % (name, _describe(result)))
+    return results
+
+
+def _describe(result):
+    if result["status"] != "ok":
+        return "%s (%s)" % (result["status"], result.get("reason"))
+    rates = ["%.1f %s" % (v, k[:-len("_per_s")] + "/s") for k, v in result.items()
+        if k.endswith("_per_s") and v is not None]
+    return "%s, peak RSS %.0f MB" % (", ".join(rates), result["peak_rss_mb"])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    """Log the change in each rate and peak RSS against a previous run."""
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if not old or old.get("status") != "ok" or result.get("status") != "ok":
+            continue
+        for key, value in result.items():
+            if (key.endswith("_per_s") or key == "peak_rss_mb") and old.get(key):
+                logging.info("%-30s %-18s %10.1f -> %10.1f (%+.1f%%)" % (name, key, old[key],
+                    value, (value / old[key] - 1) * 100))
+
+
+def _main():
+    usage = "usage: %prog [options] [benchmark ...]"
+    parser = OptionParser(usage=usage,
+                          description="Benchmark the tiling tools against local stand-in servers "
+                          "and generated fixtures. Benchmarks: " + ", ".join(n for n, _ in BENCHMARKS))
+    parser.add_option("-o", "--output", action="store", dest="output",
+        default="bench-%s.json" % time.strftime("%Y%m%dT%H%M%S"),
+        help="JSON results file (default %default)")
+    parser.add_option("-c", "--compare", action="store", dest="compare",
+        help="Previous JSON results to compare against")
+    parser.add_option("-w", "--workers", action="store", type="int", dest="workers", default=16)
+    parser.add_option("-Z", "--max-zoom", action="store", type="int", dest="max_zoom", default=8,
+        help="Max zoom downloaded by the download_tiles benchmarks (default %default)")
+    parser.add_option("--latency", action="store", type="float", dest="latency", default=0.02,
+        help="Tile server latency in seconds (default %default)")
+    parser.add_option("--error-rate", action="store", type="float", dest="error_rate", default=0.02,
+        help="Fraction of tile requests answered with 503 (default %default)")
+    parser.add_option("-n", "--objects", action="store", type="int", dest="objects", default=2000)
+    parser.add_option("--moto-port", action="store", type="int", dest="moto_port", default=5124)
+    parser.add_option("-f", "--features", action="store", type="int", dest="features", default=200000)
+    parser.add_option("--raster-size", action="store", type="int", dest="raster_size", default=8000)
+    parser.add_option("--rasters", action="store", type="int", dest="rasters", default=200)
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    names = args or [name for name, _ in BENCHMARKS]
+    unknown = [name for name in names if name not in dict(BENCHMARKS)]
+    if unknown:
+        parser.error("unknown benchmark: " + ", ".join(unknown))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": vars(options),
+        "results": run(names, options),
+    }
+    with open(options.output, "w") as f:
+        json.dump(report, f, sort_keys=True, indent=4, separators=(',', ': '))
+    logging.info("Wrote " + options.output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    _main()
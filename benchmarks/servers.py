@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Local stand-ins for the services the tools talk to:
+#
+#  - TileServer, an HTTP {z}/{x}/{y}.png server with
+#    configurable latency and error rates, answering
+#    If-None-Match with 304 like a real tile CDN;
+#  - start_moto, a moto S3 server that boto3 clients in
+#    this process reach through AWS_ENDPOINT_URL.
+#-------------------------------------------------------
+import hashlib
+import io
+import logging
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TILE_PATTERN = re.compile(r"^/(\d+)/(\d+)/(\d+)\.png$")
+## Distinct tile images served, so content varies but some tiles repeat
+TILE_VARIANTS = 16
+## Pending connections, well above socketserver's 5, so bursts of new
+## connections are not dropped and retried a second later
+LISTEN_BACKLOG = 1024
+
+
+class _TileHTTPServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+    daemon_threads = True
+
+
+def _tile_images(count):
+    try:
+        from PIL import Image
+    except ImportError:
+        return [("tile %d" % i).encode() * 64 for i in range(count)]
+    images = []
+    for i in range(count):
+        out = io.BytesIO()
+        Image.new("RGB", (256, 256), (i * 15 % 256, i * 40 % 256, 128)).save(out, "PNG")
+        images.append(out.getvalue())
+    return images
+
+
+class TileServer(object):
+    """
+    Threaded HTTP tile server on 127.0.0.1. Each request waits latency
+    seconds plus up to jitter, then fails with 503 with probability
+    error_rate, or 429 with probability rate_limit_rate.
+    """
+    def __init__(self, port=0, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+            seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._images = _tile_images(TILE_VARIANTS)
+        self._etags = ['"%s"' % hashlib.md5(image).hexdigest() for image in self._images]
+        self._httpd = _TileHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/{z}/{x}/{y}.png" % self._httpd.server_address[1]
+
+    def _outcome(self):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.random() * self.jitter
+            roll = self._random.random()
+            if roll < self.error_rate:
+                status = 503
+            elif roll < self.error_rate + self.rate_limit_rate:
+                status = 429
+            else:
+                status = 200
+            if status != 200:
+                self.errors += 1
+        return delay, status
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            ## keep-alive, so clients' connection pooling shows in the results;
+            ## every response sets Content-Length or has no body
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                match = TILE_PATTERN.match(self.path)
+                if not match:
+                    self.send_error(404)
+                    return
+                delay, status = server._outcome()
+                if delay:
+                    time.sleep(delay)
+                if status != 200:
+                    self.send_response(status)
+                    if status == 429:
+                        self.send_header("Retry-After", "0")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                z, x, y = [int(v) for v in match.groups()]
+                variant = (x * 7 + y * 13 + z) % TILE_VARIANTS
+                etag = server._etags[variant]
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                body = server._images[variant]
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def start_moto(port):
+    """Start a moto S3 server and point boto3 in this process at it."""
+    from moto.server import ThreadedMotoServer
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ["AWS_ENDPOINT_URL"] = "http://127.0.0.1:%d" % port
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(port=port, verbose=False)
+    server.start()
+    return server
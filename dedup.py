@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Content deduplication for z/x/y.png tile trees.
+#
+# Each distinct tile is kept once in a content-addressed
+# store inside the tree, path/.tiles_by_hash/ab/abcd...png,
+# and every z/x/y.png with the same md5 is a hardlink to
+# it. Tiles are always replaced with os.replace, which
+# swaps the directory entry, so rewriting one tile never
+# changes the others that share its content.
+#
+# MBTiles files deduplicate with the map/images layout
+# instead; see mbtiles.py.
+#-------------------------------------------------------
+import logging
+import os
+from optparse import OptionParser
+
+import mbtiles
+
+STORE_DIRNAME = ".tiles_by_hash"
+
+
+def store_path(path, md5):
+    return os.path.join(path, STORE_DIRNAME, md5[:2], md5 + ".png")
+
+
+def link_duplicate(path, file_path, md5):
+    """
+    Deduplicate the tile just written to file_path in the tree at path: if
+    the store already has its content, replace it with a hardlink to the
+    stored copy, otherwise add it to the store. Returns True if the tile
+    was a duplicate.
+    """
+    stored = store_path(path, md5)
+    try:
+        os.link(file_path, stored)
+        return False
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        try:
+            os.link(file_path, stored)
+            return False
+        except FileExistsError:
+            pass
+    except FileExistsError:
+        pass
+    if os.path.samefile(stored, file_path):
+        return True
+    tmp_path = "%s.%d.link" % (file_path, os.getpid())
+    os.link(stored, tmp_path)
+    os.replace(tmp_path, file_path)
+    ## the link shares the stored copy's inode and mtime, which must not be
+    ## touched: every other tile with this content would look newer too
+    return True
+
+
+def dir_report(path):
+    """
+    Return (tiles, unique images, bytes if stored per tile, bytes stored)
+    for the deduplicated part of a tile tree, from the store's link counts.
+    """
+    tiles = unique = logical = stored = 0
+    store = os.path.join(path, STORE_DIRNAME)
+    if not os.path.isdir(store):
+        return tiles, unique, logical, stored
+    for prefix in os.scandir(store):
+        for entry in os.scandir(prefix.path):
+            st = entry.stat()
+            links = st.st_nlink - 1
+            if links < 1:
+                continue
+            unique += 1
+            tiles += links
+            logical += links * st.st_size
+            stored += st.st_size
+    return tiles, unique, logical, stored
+
+
+def report(path):
+    """Dedup totals for an MBTiles file or a tile tree."""
+    if mbtiles.is_mbtiles(path):
+        return mbtiles.dedup_report(path)
+    return dir_report(path)
+
+
+def log_report(path):
+    tiles, unique, logical, stored = report(path)
+    ratio = float(tiles) / unique if unique else 1.0
+    logging.info("%d tiles stored as %d unique images (%.2fx), %d of %d bytes" % (
+        tiles, unique, ratio, stored, logical))
+
+
+def _main():
+    usage = "usage: %prog [options] PATH"
+    parser = OptionParser(usage=usage,
+                          description="Report the tile deduplication ratio of a tile tree or MBTiles file")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug",
+                      help="Turn on debug logging")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO)
+    log_report(args[0])
+
+if __name__ == "__main__":
+    _main()
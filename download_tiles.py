@@ -6,25 +6,192 @@ import os
 import mercantile
 from urllib.parse import urlparse
 import requests
-from boto.s3.connection import S3Connection
+from requests.adapters import HTTPAdapter
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, namedtuple
+import threading
+import hashlib
+import random
+import sqlite3
 import sys
+import time
+from datetime import timezone
+from email.utils import format_datetime, parsedate_to_datetime
 
-def download_tiles(minzoom, maxzoom, bbox, url, path, tile_cover=False, skip_existing=False):
-    if not os.path.exists(path):
-        os.makedirs(path)
+import dedup as dedup_store
+import instrumentation
+import mbtiles
+import pyramid
+import tile_coverage
 
-    if tile_cover:
-        ul = mercantile.tile(bbox[0], bbox[3], minzoom)
-        lr = mercantile.tile(bbox[2], bbox[1], minzoom)
-        ul_bounds = mercantile.bounds(ul.x, ul.y, ul.z)
-        lr_bounds = mercantile.bounds(lr.x, lr.y, lr.z)
-        bbox = (ul_bounds.west, lr_bounds.south, lr_bounds.east, ul_bounds.north)
+DEFAULT_WORKERS = 16
+JOURNAL_FILENAME = ".download_journal.sqlite"
+JOURNAL_COMMIT_INTERVAL = 1000
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 300
+REQUEST_TIMEOUT = 60
 
+## Returned instead of content when the server answers a conditional
+## request with 304 Not Modified.
+NOT_MODIFIED = object()
+
+## Cache validators for a previously downloaded tile.
+Validators = namedtuple("Validators", ["etag", "last_modified"])
+TileResult = namedtuple("TileResult", ["size", "md5", "etag", "last_modified"])
+FetchedTile = namedtuple("FetchedTile", ["data", "etag", "last_modified"])
+
+_thread_local = threading.local()
+
+## Request latencies, status codes and byte counts for the current run
+STATS = instrumentation.Stats()
+
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+
+def _get_session(pool_size=DEFAULT_WORKERS):
+    """
+    Return a requests Session for the calling thread, so keep-alive
+    connections are reused across tiles instead of reconnecting per request.
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.verify = False
+        _thread_local.session = session
+    return session
+
+def _get_s3_client(bucket, pool_size=DEFAULT_WORKERS):
+    """
+    Return the shared boto3 client for bucket, creating it on first use.
+    boto3 clients are thread-safe, so all download threads share one
+    connection pool per bucket.
+    """
+    client = _s3_clients.get(bucket)
+    if client is None:
+        with _s3_clients_lock:
+            client = _s3_clients.get(bucket)
+            if client is None:
+                client = boto3.client("s3", config=Config(max_pool_connections=pool_size))
+                _s3_clients[bucket] = client
+    return client
+
+class TileDownloadError(IOError):
+    """
+    A non-OK response from a tile server. retry_after is the delay in seconds
+    requested by a Retry-After header, if any.
+    """
+    def __init__(self, url, status_code, retry_after=None):
+        IOError.__init__(self, "HTTP %d for %s" % (status_code, url))
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all download threads. rate is in requests per
+    second; None means unlimited. pause() holds every caller back, which is
+    used to honor a server's Retry-After globally rather than per thread.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryPolicy(object):
+    """
+    Retries transient failures (connection errors, 429 and 5xx responses)
+    with jittered exponential backoff, waiting on the rate limiter before
+    every attempt.
+    """
+    def __init__(self, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, limiter=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = limiter or RateLimiter()
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            with STATS.timer("rate_limit_wait"):
+                self.limiter.acquire()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not _is_retryable(e):
+                    raise
+                STATS.incr("retries")
+                retry_after = getattr(e, "retry_after", None)
+                if retry_after is not None:
+                    delay = min(retry_after, MAX_BACKOFF)
+                    self.limiter.pause(delay)
+                else:
+                    ## "full jitter": uniform over [0, backoff * 2^attempt]
+                    delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * (2 ** attempt)))
+                attempt += 1
+                logging.debug("Retrying in %.2fs (attempt %d/%d): %s" % (delay, attempt, self.retries, e))
+                time.sleep(delay)
+
+
+def _is_retryable(e):
+    if isinstance(e, TileDownloadError):
+        return e.status_code == 429 or e.status_code >= 500
+    if isinstance(e, ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status == 429 or status >= 500
+    return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError))
+
+
+def _iter_tiles(minzoom, maxzoom, bbox):
+    """
+    Yield every tile covering bbox from minzoom to maxzoom, clamped to the
+    valid tile range at each zoom. A bbox whose west edge is greater than
+    its east edge crosses the antimeridian.
+    """
     for zoom in range(minzoom, maxzoom + 1):
-        tile_url_z = url.replace("{z}", str(zoom))
-        z_dir = os.path.join(path, str(zoom))
-        if not os.path.exists(z_dir):
-            os.makedirs(z_dir)
         ul = mercantile.tile(bbox[0], bbox[3], zoom)
         lr = mercantile.tile(bbox[2], bbox[1], zoom)
         if ul.x < 0:
@@ -36,63 +203,434 @@ def download_tiles(minzoom, maxzoom, bbox, url, path, tile_cover=False, skip_exi
             lr = mercantile.Tile(x=max_tile, y=lr.y, z=lr.z)
         if lr.y > max_tile:
             lr = mercantile.Tile(x=lr.x, y=max_tile, z=lr.z)
+        if bbox[0] > bbox[2]:
+            x_ranges = [range(ul.x, max_tile + 1), range(0, lr.x + 1)]
+        else:
+            x_ranges = [range(ul.x, lr.x + 1)]
         logging.info("Downloading tiles for zoom %d x:%d-%d y:%d-%d " % (zoom, ul.x, lr.x, ul.y, lr.y))
-        for x in range(ul.x, lr.x + 1):
-            x_dir = os.path.join(z_dir, str(x))
-            if not os.path.exists(x_dir):
-                os.makedirs(x_dir)
-            tile_url_x = tile_url_z.replace("{x}", str(x))
-            for y in range(ul.y, lr.y + 1):
-                tile_url_y = tile_url_x.replace("{y}", str(y))
-                file_path = os.path.join(x_dir, str(y) + ".png")
-                try:
-                    download_tile(tile_url_y, file_path, skip_existing=skip_existing)
-                except Exception as e:
-                    logging.debug(e)
-                    logging.error("Failed to download tile: " + tile_url_y)
+        for x_range in x_ranges:
+            for x in x_range:
+                for y in range(ul.y, lr.y + 1):
+                    yield mercantile.Tile(x=x, y=y, z=zoom)
+
+
+def _tile_url(url, tile):
+    return url.replace("{z}", str(tile.z)).replace("{x}", str(tile.x)).replace("{y}", str(tile.y))
+
+
+class DownloadJournal(object):
+    """
+    Append-only record of tile outcomes, stored as SQLite in the output
+    directory. Completed tiles are recorded with their size and md5 so a
+    resumed run can skip them without touching the filesystem, and with
+    their ETag/Last-Modified so a forced refresh can make conditional
+    requests. With track_changed, written tiles are also kept in the
+    changed set and in a pyramid_pending table until their parents are
+    rebuilt, so tiles written by a run that stopped before building the
+    pyramid are picked up by the next one.
+    """
+    def __init__(self, path, track_changed=False):
+        self.path = path
+        self.counts = Counter()
+        self.changed = set() if track_changed else None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tiles ("
+            "z INTEGER, x INTEGER, y INTEGER, status TEXT, size INTEGER, md5 TEXT, "
+            "PRIMARY KEY (z, x, y))")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(tiles)")]
+        for column in ("etag", "last_modified"):
+            if column not in columns:
+                self._conn.execute("ALTER TABLE tiles ADD COLUMN %s TEXT" % column)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS pyramid_pending ("
+            "z INTEGER, x INTEGER, y INTEGER, PRIMARY KEY (z, x, y))")
+        self._conn.commit()
+        if track_changed:
+            self.changed = set(mercantile.Tile(x, y, z) for z, x, y in
+                self._conn.execute("SELECT z, x, y FROM pyramid_pending"))
+
+    def completed(self, zoom):
+        """Return the set of (x, y) recorded as done at zoom."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT x, y FROM tiles WHERE z = ? AND status = 'done'", (zoom,))
+            return set(rows)
+
+    def validators(self, zoom):
+        """Return {(x, y): Validators} for done tiles at zoom that have any."""
+        with self._lock:
+            rows = self._conn.execute("SELECT x, y, etag, last_modified FROM tiles "
+                "WHERE z = ? AND status = 'done' AND (etag IS NOT NULL OR last_modified IS NOT NULL)",
+                (zoom,))
+            return dict(((x, y), Validators(etag, last_modified)) for x, y, etag, last_modified in rows)
+
+    def record(self, tile, status, size=None, md5=None, etag=None, last_modified=None):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO tiles "
+                "(z, x, y, status, size, md5, etag, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (tile.z, tile.x, tile.y, status, size, md5, etag, last_modified))
+            if status == "done" and self.changed is not None:
+                self.changed.add(tile)
+                self._conn.execute("INSERT OR IGNORE INTO pyramid_pending (z, x, y) VALUES (?, ?, ?)",
+                    (tile.z, tile.x, tile.y))
+            self._tick(status)
+
+    def record_not_modified(self, tile):
+        """A 304 leaves the stored tile, size, md5 and validators as they were."""
+        with self._lock:
+            self._tick("not_modified")
+
+    def _tick(self, status):
+        STATS.incr("tiles_" + status)
+        self.counts[status] += 1
+        self._pending += 1
+        if self._pending >= JOURNAL_COMMIT_INTERVAL:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+def _clear_pyramid_pending(journal_path, zoom):
+    """Forget the pending tiles at zoom once their parents are built."""
+    conn = sqlite3.connect(journal_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM pyramid_pending WHERE z = ?", (zoom,))
+    finally:
+        conn.close()
+
+
+def _journal_path(path):
+    if mbtiles.is_mbtiles(path):
+        return os.path.splitext(path)[0] + JOURNAL_FILENAME
+    return os.path.join(path, JOURNAL_FILENAME)
+
+
+def _download_one(url, path, tile, skip_existing, workers, journal, writer, policy, validators=None,
+        dedup=False):
+    tile_url = _tile_url(url, tile)
+    ## every outcome, including retries and failures
+    start = time.perf_counter()
+    try:
+        if writer is not None:
+            fetched = policy.call(fetch_tile, tile_url, session=_get_session(workers),
+                pool_size=workers, validators=validators)
+            if fetched is NOT_MODIFIED:
+                journal.record_not_modified(tile)
+            elif fetched is not None:
+                ## recorded in the journal once the writer commits it
+                writer.put(tile, fetched.data, fetched)
+            STATS.observe("tile", time.perf_counter() - start)
+            return
+        x_dir = os.path.join(path, str(tile.z), str(tile.x))
+        file_path = os.path.join(x_dir, str(tile.y) + ".png")
+        ## checked before the rate limiter, so existing tiles cost no token
+        if skip_existing and os.path.exists(file_path):
+            logging.debug("%s exists, skipping" % file_path)
+            return
+        os.makedirs(x_dir, exist_ok=True)
+        result = policy.call(download_tile, tile_url, file_path, skip_existing=skip_existing,
+            session=_get_session(workers), pool_size=workers, validators=validators)
+    except Exception as e:
+        STATS.observe("tile", time.perf_counter() - start)
+        logging.debug(e)
+        logging.error("Failed to download tile: " + tile_url)
+        journal.record(tile, "failed")
+        return
+    STATS.observe("tile", time.perf_counter() - start)
+    if result is NOT_MODIFIED:
+        journal.record_not_modified(tile)
+    elif result is not None:
+        if dedup:
+            dedup_store.link_duplicate(path, file_path, result.md5)
+        journal.record(tile, "done", *result)
+
+
+def download_tiles(minzoom, maxzoom, bbox, url, path, tile_cover=False, skip_existing=False,
+        workers=DEFAULT_WORKERS, max_inflight=None, resume=False,
+        retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, rps=None, geojson=None,
+        build_pyramid=False, processes=None, dedup=False, stats_interval=None, stats_file=None,
+        prometheus_textfile=None, pyramid_orphans=False):
+    """
+    Download all tiles in bbox from minzoom to maxzoom. If geojson is given
+    only the tiles covering its geometries are downloaded and bbox is
+    ignored. If path ends in .mbtiles tiles are written into that MBTiles
+    file, otherwise into a path/z/x/y.png tree.
+
+    With build_pyramid only maxzoom is downloaded, and the lower zooms are
+    built from it locally with a pool of processes. Parents are rebuilt
+    for the tiles written in this run and tiles a previous run wrote
+    without building their parents. pyramid_orphans also scans the whole
+    of maxzoom for tiles whose parent is missing. Parents on the edge of the area are built from the children that
+    exist, so the rest of such a parent is transparent.
+
+    With dedup identical tiles are stored once: as hardlinks into a
+    content-addressed store in a tile tree, or in the map/images layout
+    of a new MBTiles file.
+
+    Request latency, time per tile across all attempts (whatever the
+    outcome), status codes and bytes are recorded in STATS. Every
+    stats_interval seconds a JSON snapshot is logged or appended to
+    stats_file, and prometheus_textfile is rewritten; a summary is logged
+    at the end.
+    """
+    STATS.reset()
+    reporter = instrumentation.StatsReporter(STATS, "download_tiles", stats_interval,
+        stats_file, prometheus_textfile)
+
+    ## stopped however the run ends, so the summary and textfile are final
+    try:
+        to_mbtiles = mbtiles.is_mbtiles(path)
+        out_dir = os.path.dirname(os.path.abspath(path)) if to_mbtiles else path
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+
+        fetch_minzoom = maxzoom if build_pyramid else minzoom
+        if geojson is not None:
+            cover = tile_coverage.Coverage(geojson)
+            bbox = cover.bounds
+            tiles = cover.tiles(fetch_minzoom, maxzoom)
+        elif tile_cover:
+            ul = mercantile.tile(bbox[0], bbox[3], minzoom)
+            lr = mercantile.tile(bbox[2], bbox[1], minzoom)
+            ul_bounds = mercantile.bounds(ul.x, ul.y, ul.z)
+            lr_bounds = mercantile.bounds(lr.x, lr.y, lr.z)
+            bbox = (ul_bounds.west, lr_bounds.south, lr_bounds.east, ul_bounds.north)
+        if geojson is None:
+            tiles = _iter_tiles(fetch_minzoom, maxzoom, bbox)
+
+        ## Bound the number of submitted-but-unfinished tiles so the tile
+        ## generator is consumed lazily instead of queueing a whole zoom level.
+        if max_inflight is None:
+            max_inflight = workers * 4
+        inflight = threading.BoundedSemaphore(max_inflight)
+
+        def _release(future):
+            inflight.release()
+
+        policy = RetryPolicy(retries, backoff, RateLimiter(rps))
+
+        ## When resuming, the journal replaces per-tile os.path.exists checks.
+        ## the pyramid is rebuilt from the tiles written (here and by runs that
+        ## stopped before the pyramid step) rather than from file mtimes, which
+        ## deduplicated tiles share with their copies
+        journal = DownloadJournal(_journal_path(path), track_changed=build_pyramid)
+        if resume:
+            skip_existing = False
+
+        writer = None
+        if to_mbtiles:
+            def _journal_batch(batch):
+                for tile, data, fetched in batch:
+                    journal.record(tile, "done", len(data), hashlib.md5(data).hexdigest(),
+                        fetched.etag, fetched.last_modified)
+
+            writer = mbtiles.MBTilesWriter(path, metadata={
+                "name": os.path.splitext(os.path.basename(path))[0],
+                "format": "png",
+                "minzoom": minzoom,
+                "maxzoom": maxzoom,
+                "bounds": ",".join(str(b) for b in bbox),
+            }, on_commit=_journal_batch, dedup=dedup)
+
+        def _completed(zoom):
+            if resume:
+                return journal.completed(zoom)
+            if skip_existing and to_mbtiles:
+                return mbtiles.existing_tiles(path, zoom)
+            return set()
+
+        ## Tiles that will be refetched anyway are requested conditionally
+        ## against the validators recorded when they were last downloaded.
+        conditional = not skip_existing and not resume
+
+        def _validators(zoom):
+            validators = journal.validators(zoom)
+            if to_mbtiles and validators:
+                ## a 304 for a tile missing from a replaced or rebuilt file
+                ## would leave a hole
+                stored = mbtiles.existing_tiles(path, zoom)
+                validators = dict((xy, v) for xy, v in validators.items() if xy in stored)
+            return validators
+
+        current_zoom, completed, validators = None, set(), {}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for tile in tiles:
+                    if tile.z != current_zoom:
+                        current_zoom, completed = tile.z, _completed(tile.z)
+                        if conditional:
+                            validators = _validators(tile.z)
+                    if (tile.x, tile.y) in completed:
+                        continue
+                    inflight.acquire()
+                    future = pool.submit(_download_one, url, path, tile, skip_existing,
+                        workers, journal, writer, policy, validators.get((tile.x, tile.y)), dedup)
+                    future.add_done_callback(_release)
+        finally:
+            if writer is not None:
+                with STATS.timer("mbtiles_flush"):
+                    writer.close()
+            journal.close()
+        logging.info("Downloaded %d tiles, %d not modified, %d failed" % (
+            journal.counts["done"], journal.counts["not_modified"], journal.counts["failed"]))
+
+        if build_pyramid and maxzoom > minzoom:
+            with STATS.timer("pyramid"):
+                changed = journal.changed
+                if pyramid_orphans:
+                    changed = changed | pyramid.orphaned_tiles(path, maxzoom)
+                built = pyramid.build_pyramid(path, maxzoom, minzoom, changed=changed,
+                    processes=processes, dedup=dedup)
+            _clear_pyramid_pending(_journal_path(path), maxzoom)
+            STATS.incr("tiles_built", built)
+            logging.info("Built %d tiles for zooms %d-%d" % (built, minzoom, maxzoom - 1))
+
+        if dedup:
+            dedup_store.log_report(path)
+    finally:
+        reporter.stop()
 
 
 CHUNK_SIZE = 1024
-def download_tile(url, path, skip_existing=False):
+def download_tile(url, path, skip_existing=False, session=None, pool_size=DEFAULT_WORKERS,
+        validators=None):
+    """
+    Download url to path. The tile is streamed to a temporary file which is
+    renamed into place once complete, so a crash never leaves a truncated
+    tile behind. If validators are given and path exists the request is
+    conditional.
+
+    Returns a TileResult for the written file, NOT_MODIFIED if the existing
+    file is current, or None if nothing was written.
+    """
     if skip_existing and os.path.exists(path):
         logging.debug("%s exists, skipping" % path)
-        return
+        return None
+    if validators is not None and not os.path.exists(path):
+        validators = None
 
     logging.debug("Downloading %s to %s" % (url, path))
+    opened = _open_tile(url, session, pool_size, validators)
+    if opened is None or opened is NOT_MODIFIED:
+        return opened
+    chunks, etag, last_modified = opened
+    size, md5 = _write_atomic(path, chunks)
+    STATS.incr("bytes", size)
+    return TileResult(size, md5, etag, last_modified)
+
+
+def fetch_tile(url, session=None, pool_size=DEFAULT_WORKERS, validators=None):
+    """
+    Download url, returning a FetchedTile, NOT_MODIFIED if validators are
+    given and still match, or None if the tile does not exist.
+    """
+    logging.debug("Downloading %s" % url)
+    opened = _open_tile(url, session, pool_size, validators)
+    if opened is None or opened is NOT_MODIFIED:
+        return opened
+    chunks, etag, last_modified = opened
+    data = b"".join(chunks)
+    STATS.incr("bytes", len(data))
+    return FetchedTile(data, etag, last_modified)
+
+
+def _open_tile(url, session, pool_size, validators=None):
+    """
+    Start downloading url, returning (content iterator, etag, last_modified),
+    NOT_MODIFIED, or None if an s3:// key does not exist.
+    """
     parsed_url = urlparse(url)
 
     if parsed_url.scheme == "s3":
-        conn = S3Connection(calling_format='boto.s3.connection.OrdinaryCallingFormat')
-        if conn is None:
-            raise Exception("Error connecting to s3")
-        bucket = conn.get_bucket(parsed_url.netloc, validate=False)
-        if bucket is None:
-            raise Exception("Error getting s3 bucket")
-        key = bucket.get_key(parsed_url.path)
-        if key is not None:
-            with open(path, "wb") as f:
-                key.get_contents_to_file(f)
-    else:
-        res = requests.get(url, stream=True, verify=False)
-
-        if not res.ok:
-            raise IOError
-
-        with open(path, "wb") as f:
-            for chunk in res.iter_content(CHUNK_SIZE):
+        s3 = _get_s3_client(parsed_url.netloc, pool_size)
+        conditions = {}
+        if validators is not None:
+            if validators.etag:
+                conditions["IfNoneMatch"] = validators.etag
+            elif validators.last_modified:
+                conditions["IfModifiedSince"] = parsedate_to_datetime(validators.last_modified)
+        try:
+            with STATS.timer("request"):
+                obj = s3.get_object(Bucket=parsed_url.netloc, Key=parsed_url.path.lstrip("/"), **conditions)
+            STATS.incr("status_200")
+        except ClientError as e:
+            STATS.incr("status_%s" % e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", "error"))
+            if e.response["Error"]["Code"] in ("304", "NotModified"):
+                return NOT_MODIFIED
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                logging.debug("%s not found" % url)
+                return None
+            raise
+        last_modified = obj.get("LastModified")
+        if last_modified is not None:
+            last_modified = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+        return obj["Body"].iter_chunks(CHUNK_SIZE), obj.get("ETag"), last_modified
+
+    if session is None:
+        session = _get_session()
+    headers = {}
+    if validators is not None:
+        if validators.etag:
+            headers["If-None-Match"] = validators.etag
+        if validators.last_modified:
+            headers["If-Modified-Since"] = validators.last_modified
+    try:
+        with STATS.timer("request"):
+            res = session.get(url, stream=True, verify=False, timeout=REQUEST_TIMEOUT, headers=headers)
+    except requests.exceptions.RequestException as e:
+        STATS.incr("status_" + type(e).__name__)
+        raise
+    STATS.incr("status_%d" % res.status_code)
+
+    if res.status_code == 304:
+        res.close()
+        return NOT_MODIFIED
+    if not res.ok:
+        res.close()
+        raise TileDownloadError(url, res.status_code,
+            _parse_retry_after(res.headers.get("Retry-After")))
+
+    return res.iter_content(CHUNK_SIZE), res.headers.get("ETag"), res.headers.get("Last-Modified")
+
+
+def _write_atomic(path, chunks):
+    tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+    md5 = hashlib.md5()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
                 f.write(chunk)
+                md5.update(chunk)
+                size += len(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size, md5.hexdigest()
 
 
 def _main():
-    usage = "usage: %prog"
+    usage = "usage: %prog [options] URL OUTPUT"
     parser = OptionParser(usage=usage,
-                          description="")
+                          description="Download {z}/{x}/{y} tiles from URL into an OUTPUT directory, "
+                          "or into an MBTiles file if OUTPUT ends in .mbtiles")
     parser.add_option("-d", "--debug", action="store_true", dest="debug",
                       help="Turn on debug logging")
     parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
                       help="turn off all logging")
     parser.add_option("-f", "--force", action="store_true", dest="force",
-                      help="Redownload existing tiles.")
+                      help="Redownload existing tiles. Tiles with a recorded ETag or "
+                      "Last-Modified are requested conditionally and kept if unchanged.")
     parser.add_option("-z", "--min-zoom", action="store", type="int", 
         dest="min_zoom", default=0)
     parser.add_option("-Z", "--max-zoom", action="store", type="int", 
@@ -100,6 +638,41 @@ def _main():
     parser.add_option("-b", "--bbox", action="store", dest="bbox", default="-180,-85.05113,180,85.05113")
     parser.add_option("-t", "--tile-cover", action="store_true", dest="tileCover", default=False,
         help="Download all tiles covered by extent at min zoom")
+    parser.add_option("-g", "--geojson", action="store", dest="geojson", default=None,
+        help="Only download tiles covering the geometries in this GeoJSON file, instead of a bbox")
+    parser.add_option("-w", "--workers", action="store", type="int", dest="workers",
+        default=DEFAULT_WORKERS, help="Number of concurrent download threads (default %d)" % DEFAULT_WORKERS)
+    parser.add_option("--max-inflight", action="store", type="int", dest="max_inflight",
+        default=None, help="Maximum number of queued and running tile downloads (default 4 * workers)")
+    parser.add_option("-r", "--resume", action="store_true", dest="resume", default=False,
+        help="Skip tiles recorded as complete in the download journal instead of checking for existing files")
+    parser.add_option("--retries", action="store", type="int", dest="retries", default=DEFAULT_RETRIES,
+        help="Times to retry a tile after a connection error, 429 or 5xx response (default %d)" % DEFAULT_RETRIES)
+    parser.add_option("--backoff", action="store", type="float", dest="backoff", default=DEFAULT_BACKOFF,
+        help="Base delay in seconds for jittered exponential backoff between retries (default %g)" % DEFAULT_BACKOFF)
+    parser.add_option("--rps", action="store", type="float", dest="rps", default=None,
+        help="Maximum requests per second across all workers (default unlimited)")
+
+    parser.add_option("-P", "--pyramid", action="store_true", dest="pyramid", default=False,
+        help="Only download the max zoom and build lower zooms locally by downsampling, "
+        "rebuilding only tiles whose children changed. Parents on the edge of the area are "
+        "transparent where children are missing")
+    parser.add_option("--pyramid-orphans", action="store_true", dest="pyramid_orphans",
+        default=False, help="With --pyramid, also scan every max zoom tile for ones whose parent "
+        "is missing, e.g. written without the journal, and build their parents")
+    parser.add_option("-D", "--dedup", action="store_true", dest="dedup", default=False,
+        help="Store identical tiles once: hardlinked to a content-addressed copy in a tile tree, "
+        "or in the map/images layout of a new MBTiles file")
+    parser.add_option("--stats-interval", action="store", type="float", dest="stats_interval",
+        default=None, help="Every this many seconds, log a JSON line of request counts, "
+        "rates and latency percentiles (or append it to --stats-file)")
+    parser.add_option("--stats-file", action="store", dest="stats_file", default=None,
+        help="Append periodic JSON stats lines to this file instead of the log")
+    parser.add_option("--prometheus-textfile", action="store", dest="prometheus_textfile", default=None,
+        help="Rewrite this Prometheus textfile with counters and latency histograms "
+        "every --stats-interval seconds and at exit")
+    parser.add_option("--processes", action="store", type="int", dest="processes", default=None,
+        help="Number of processes building pyramid tiles (default: one per CPU)")
 
     (options, args) = parser.parse_args()
  
@@ -111,18 +684,28 @@ def _main():
         logging.error("BBOX must have 4 components")
         sys.exit(-1)
     bounds = [float(f) for f in bounds]
-    if bounds[0] > bounds[2] or bounds[1] > bounds[3] or \
+    if bounds[1] > bounds[3] or \
         abs(bounds[0]) > 180 or abs(bounds[2]) > 180 or \
         abs(bounds[1]) > 90 or abs(bounds[3]) > 90:
         logging.error("BBOX is in incorrect order or contains values out of range, must be W,S,E,N.\n" +
-        "If you are trying to specify a region that crosses the antimeridian," + 
-        " it must be split into 2 regions, split at the antimeridian.")
+        "A region that crosses the antimeridian has W greater than E.")
+        sys.exit(-1)
+
+    if options.rps is not None and options.rps <= 0:
+        logging.error("--rps must be greater than 0")
         sys.exit(-1)
 
+    geojson = tile_coverage.load_geojson(options.geojson) if options.geojson else None
+
     url = args[0]
     path = args[1]
     download_tiles(options.min_zoom, options.max_zoom, bounds, url, path, 
-        tile_cover=options.tileCover, skip_existing=(not options.force))
+        tile_cover=options.tileCover, skip_existing=(not options.force),
+        workers=options.workers, max_inflight=options.max_inflight, resume=options.resume,
+        retries=options.retries, backoff=options.backoff, rps=options.rps, geojson=geojson,
+        build_pyramid=options.pyramid, processes=options.processes, dedup=options.dedup,
+        stats_interval=options.stats_interval, stats_file=options.stats_file,
+        prometheus_textfile=options.prometheus_textfile, pyramid_orphans=options.pyramid_orphans)
 
 if __name__ == "__main__":
     _main()
\ No newline at end of file
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Decodes HTML character entities and strips newlines in
+# the properties of line-delimited GeoJSON, like
+# geojson-strip-html/index.js, but in parallel:
+#
+#  - the input is split into byte ranges of CHUNK_BYTES;
+#    a chunk owns every line that starts inside it, so
+#    workers need no coordination;
+#  - chunks are cleaned in a process pool and written in
+#    input order, one feature per line;
+#  - lines that are not valid JSON are reported by line
+#    number (and optionally saved) instead of being
+#    written through; the header and footer lines of a
+#    one-feature-per-line FeatureCollection are dropped;
+#  - with --summary, property values are summarized in
+#    the same pass, as ogr_value_summary does for OGR
+#    layers.
+#
+# orjson is used if installed, otherwise json.
+#-------------------------------------------------------
+import html
+import json
+import logging
+from optparse import OptionParser
+import os
+import re
+import sys
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from layer_summary import print_layer_summary
+from sketches import ExactCounts, StringSketch, QuantileSample, \
+    DEFAULT_PRECISION, DEFAULT_TOP_K, DEFAULT_SAMPLE_SIZE
+
+CHUNK_BYTES = 16 * 1024 * 1024
+## Chunks cleaned ahead of the writer, per worker process
+CHUNKS_AHEAD = 2
+## Failed lines logged individually before only counting them
+MAX_LOGGED_FAILURES = 10
+## Digit runs that may be integers outside orjson's 64-bit range
+LONG_DIGITS = re.compile(rb"\d{19}")
+## The opening and closing lines of a FeatureCollection written one feature per line
+COLLECTION_HEADER = re.compile(rb'^\{\s*"type"\s*:\s*"FeatureCollection"\s*,\s*"features"\s*:\s*\[$')
+COLLECTION_FOOTER = re.compile(rb"^\]\s*\}?$")
+
+
+def _loads(line):
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            ## e.g. NaN, which json accepts
+            pass
+    return json.loads(line)
+
+
+def _dumps(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def clean_properties(properties):
+    """
+    Remove newlines from and then decode HTML entities in the string values
+    of properties, dropping null and empty values. Returns the new
+    properties and whether anything changed.
+    """
+    cleaned = {}
+    changed = False
+    for key, value in properties.items():
+        if value is None or value == "":
+            changed = True
+            continue
+        if isinstance(value, str) and ('&' in value or '\n' in value or '\r' in value):
+            new_value = html.unescape(value.replace('\r\n', '').replace('\n', '').replace('\r', ''))
+            changed = changed or new_value != value
+            value = new_value
+        cleaned[key] = value
+    return cleaned, changed
+
+
+class FieldSummary(object):
+    """
+    Summary of one property: strings (and booleans, lists and objects as
+    JSON) are counted like an OGR String field, numbers sampled like an
+    Integer or Real field. A property with both is reported as String,
+    with the count of its numeric values under "numeric".
+    """
+    def __init__(self, approximate=False, precision=DEFAULT_PRECISION, top_k=DEFAULT_TOP_K,
+            sample_size=DEFAULT_SAMPLE_SIZE, seed=0):
+        self.strings = StringSketch(precision, top_k) if approximate else ExactCounts()
+        self.numbers = QuantileSample(sample_size, seed)
+        self.nulls = 0
+        self.real = False
+
+    def update(self, strings, numbers, nulls, real):
+        self.strings.update(strings)
+        self.numbers.update(numbers)
+        self.nulls += nulls
+        self.real = self.real or real
+
+    def merge(self, other):
+        self.strings.merge(other.strings)
+        self.numbers.merge(other.numbers)
+        self.nulls += other.nulls
+        self.real = self.real or other.real
+
+    def summary(self):
+        summary = self.strings.summary()
+        if summary["count"] or not self.numbers.count:
+            summary["type"] = "String"
+            if self.numbers.count:
+                summary["numeric"] = self.numbers.count
+        else:
+            summary = self.numbers.summary()
+            summary["type"] = "Real" if self.real else "Integer"
+        summary["nulls"] = self.nulls
+        return summary
+
+
+class _Columns(object):
+    """Property values of one chunk, buffered so each summary is updated once."""
+    def __init__(self):
+        self.strings = {}
+        self.numbers = {}
+        self.nulls = Counter()
+        self.real = set()
+
+    def add(self, properties, cleaned):
+        """Add the cleaned values; properties dropped as null or empty count as nulls."""
+        if len(cleaned) != len(properties):
+            for key in properties:
+                if key not in cleaned:
+                    self.nulls[key] += 1
+        for key, value in cleaned.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.numbers.setdefault(key, []).append(value)
+                if isinstance(value, float):
+                    self.real.add(key)
+                continue
+            if not isinstance(value, str):
+                value = _dumps(value).decode('utf-8')
+            counts = self.strings.get(key)
+            if counts is None:
+                counts = self.strings[key] = Counter()
+            counts[value] += 1
+
+    def summarize(self, seed, **kwargs):
+        summaries = {}
+        for key in list(self.strings) + list(self.numbers) + list(self.nulls):
+            if key in summaries:
+                continue
+            summaries[key] = FieldSummary(seed=seed, **kwargs)
+            summaries[key].update(self.strings.get(key, {}), self.numbers.get(key, []),
+                self.nulls[key], key in self.real)
+        return summaries
+
+
+def _read_chunk(f, start, end):
+    """Bytes of the lines starting in [start, end), read whole."""
+    if start > 0:
+        ## the line spanning start belongs to the previous chunk
+        f.seek(start - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    first = f.tell()
+    if first >= end:
+        return b""
+    data = f.read(end - first)
+    if not data.endswith(b"\n"):
+        data += f.readline()
+    return data
+
+
+def clean_chunk(path, index, start, end, summary_kwargs=None):
+    """
+    Process pool worker: clean the lines starting in [start, end) of path.
+    Returns (output bytes, number of input lines, [(line index in chunk,
+    raw line)] of failed lines, {property: FieldSummary} or None).
+    """
+    with open(path, "rb") as f:
+        data = _read_chunk(f, start, end)
+    lines = data.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+
+    out = []
+    failed = []
+    columns = _Columns() if summary_kwargs is not None else None
+    for i, raw in enumerate(lines):
+        line = raw.strip()
+        if COLLECTION_HEADER.match(line) or COLLECTION_FOOTER.match(line):
+            ## not features, but not errors either
+            continue
+        if line.startswith(b","):
+            line = line[1:]
+        if line.endswith(b","):
+            line = line[:-1]
+        if not line:
+            continue
+        try:
+            feature = _loads(line)
+        except ValueError:
+            failed.append((i, raw))
+            continue
+        properties = feature.get("properties") if isinstance(feature, dict) else None
+        if isinstance(properties, dict):
+            cleaned, changed = clean_properties(properties)
+            if (changed or columns is not None) and orjson is not None and LONG_DIGITS.search(line):
+                ## orjson reads integers beyond 64 bits as floats; keep them exact
+                feature = json.loads(line)
+                properties = feature["properties"]
+                cleaned = clean_properties(properties)[0]
+            if columns is not None:
+                columns.add(properties, cleaned)
+            if changed:
+                feature["properties"] = cleaned
+                line = _dumps(feature)
+        out.append(line)
+    if out:
+        out.append(b"")
+
+    summaries = None
+    if columns is not None:
+        ## distinct seeds, so merged samples stay independent
+        summaries = columns.summarize(seed=index, **summary_kwargs)
+    return b"\n".join(out), len(lines), failed, summaries
+
+
+def _chunk_ranges(size, chunk_bytes):
+    return [(start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+def iter_cleaned_chunks(path, processes=None, chunk_bytes=CHUNK_BYTES, summary_kwargs=None):
+    """
+    Yield the results of clean_chunk for every chunk of path, in order,
+    keeping at most CHUNKS_AHEAD chunks per process in flight.
+    """
+    ranges = _chunk_ranges(os.path.getsize(path), chunk_bytes)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        ahead = (processes or os.cpu_count() or 1) * CHUNKS_AHEAD
+        pending = deque()
+        for index, (start, end) in enumerate(ranges):
+            pending.append(pool.submit(clean_chunk, path, index, start, end, summary_kwargs))
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def strip_html(input_path, output_path, processes=None, chunk_bytes=CHUNK_BYTES,
+        failed_path=None, summary_kwargs=None):
+    """
+    Write the cleaned features of input_path to output_path, one per line.
+    Lines that are not valid JSON are left out, logged by line number and
+    appended to failed_path if given. With summary_kwargs (the sketch
+    options of FieldSummary) returns {property: summary dict}, otherwise
+    None.
+    """
+    tmp_path = output_path + ".tmp"
+    lines_before = 0
+    features = 0
+    failures = 0
+    summaries = {} if summary_kwargs is not None else None
+    failed_file = open(failed_path, "ab") if failed_path else None
+    try:
+        with open(tmp_path, "wb") as out:
+            for data, line_count, failed, chunk_summaries in iter_cleaned_chunks(input_path,
+                    processes, chunk_bytes, summary_kwargs):
+                out.write(data)
+                features += data.count(b"\n")
+                for i, raw in failed:
+                    failures += 1
+                    if failures <= MAX_LOGGED_FAILURES:
+                        logging.error("Invalid JSON on line %d: %s" % (lines_before + i + 1,
+                            raw[:80].decode('utf-8', 'replace')))
+                    if failed_file is not None:
+                        failed_file.write(raw.rstrip(b"\r") + b"\n")
+                lines_before += line_count
+                if chunk_summaries:
+                    for key, summary in chunk_summaries.items():
+                        if key in summaries:
+                            summaries[key].merge(summary)
+                        else:
+                            summaries[key] = summary
+        os.replace(tmp_path, output_path)
+    finally:
+        if failed_file is not None:
+            failed_file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    logging.info("Wrote %d features to %s, %d invalid lines skipped" % (features, output_path,
+        failures))
+    if summaries is None:
+        return None
+    return dict((key, summaries[key].summary()) for key in sorted(summaries))
+
+
+def output_filename(name):
+    root, ext = os.path.splitext(name)
+    return "%s-cleaned%s" % (root, ext or ".geojson")
+
+
+def _main():
+    usage = "usage: %prog [options] INPUT [OUTPUT]"
+    parser = OptionParser(usage=usage,
+                          description="Decode HTML character entities and remove newlines in the "
+                          "properties of a line-delimited GeoJSON file. OUTPUT defaults to "
+                          "INPUT-cleaned.geojson")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug",
+                      help="Turn on debug logging")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
+                      help="turn off all logging")
+    parser.add_option("-p", "--processes", action="store", type="int", dest="processes",
+                      help="Number of worker processes (default: one per CPU)")
+    parser.add_option("--chunk-size", action="store", type="int", dest="chunk_mb",
+                      default=CHUNK_BYTES // (1024 * 1024),
+                      help="MB of input per worker task (default %default)")
+    parser.add_option("--failed", action="store", dest="failed", default=None,
+                      help="Append lines that are not valid JSON to this file")
+    parser.add_option("-s", "--summary", action="store_true", dest="summary",
+                      help="Also print a summary of the property values, like ogr_value_summary")
+    parser.add_option("-a", "--approximate", action="store_true", dest="approximate",
+                      help="Summarize string properties with bounded-memory sketches: an approximate "
+                      "distinct count and the most common values")
+    parser.add_option("--precision", action="store", type="int", dest="precision",
+                      default=DEFAULT_PRECISION,
+                      help="HyperLogLog precision; each property uses 2^precision bytes (default %default)")
+    parser.add_option("-k", "--top-k", action="store", type="int", dest="top_k",
+                      default=DEFAULT_TOP_K, help="Most common values to report (default %default)")
+    parser.add_option("--sample-size", action="store", type="int", dest="sample_size",
+                      default=DEFAULT_SAMPLE_SIZE,
+                      help="Values sampled per numeric property for quantiles (default %default)")
+    parser.add_option("-j", "--json", action="store_true", dest="json",
+                      help="Print the summary as a JSON document instead of text")
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else
+    (logging.ERROR if options.quiet else logging.INFO))
+
+    if len(args) not in (1, 2):
+        parser.error("expected an input file and an optional output file")
+    input_path = args[0]
+    output_path = args[1] if len(args) == 2 else output_filename(input_path)
+    if not os.path.exists(input_path):
+        logging.error("The input file %s does not exist" % input_path)
+        sys.exit(1)
+    if os.path.exists(output_path):
+        logging.error("The output file %s already exists. Please move or delete it before "
+            "continuing" % output_path)
+        sys.exit(1)
+
+    summary_kwargs = None
+    if options.summary:
+        summary_kwargs = dict(approximate=options.approximate, precision=options.precision,
+            top_k=options.top_k, sample_size=options.sample_size)
+    fields = strip_html(input_path, output_path, options.processes,
+        options.chunk_mb * 1024 * 1024, options.failed, summary_kwargs)
+
+    if fields is None:
+        return
+    if options.json:
+        for summary in fields.values():
+            if "values" in summary:
+                summary["values"] = dict((str(k), v) for k, v in summary["values"].items())
+        print(json.dumps({input_path: fields}, sort_keys=True, indent=4, separators=(',', ': ')))
+    else:
+        print("File: " + input_path)
+        print_layer_summary(os.path.basename(input_path), fields)
+
+if __name__ == "__main__":
+    _main()
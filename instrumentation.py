@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Counters, stage timers and latency histograms for long
+# running tools.
+#
+# Stats is cheap enough to leave on all the time: a lock,
+# a Counter and a fixed set of histogram buckets per
+# stage. StatsReporter periodically writes a snapshot as
+# a JSON line (to the log or a file) and/or a Prometheus
+# textfile for node_exporter's textfile collector, and
+# logs a summary when stopped.
+#-------------------------------------------------------
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+## Histogram bucket upper bounds in seconds, as Prometheus "le" labels
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+PERCENTILES = (0.5, 0.9, 0.99)
+DEFAULT_INTERVAL = 10
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """Estimate by linear interpolation within the bucket holding p."""
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i]
+                if high == float("inf"):
+                    return low
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+
+class Stats(object):
+    """
+    Thread-safe counters and per-stage latency histograms. Snapshots also
+    give each counter as a per-second rate over the run.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start = time.time()
+            self.counters = Counter()
+            self.histograms = {}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Counters, per-second rates and latency percentiles as a dict."""
+        with self._lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            stages = {}
+            for stage, h in self.histograms.items():
+                stages[stage] = {"count": h.count, "seconds": round(h.sum, 3),
+                    "mean": round(h.sum / h.count, 4) if h.count else None}
+                for p in PERCENTILES:
+                    value = h.percentile(p)
+                    stages[stage]["p%d" % int(p * 100)] = round(value, 4) if value is not None else None
+            return {"elapsed": round(elapsed, 1), "counters": dict(self.counters),
+                "rates": dict((name, round(value / elapsed, 2)) for name, value in self.counters.items()),
+                "stages": stages}
+
+    def prometheus_text(self, prefix, labels=None):
+        """Prometheus text exposition of the counters and histograms."""
+        label_text = ",".join('%s="%s"' % item for item in sorted((labels or {}).items()))
+
+        def _labels(extra=None):
+            parts = [p for p in (label_text, extra) if p]
+            return "{%s}" % ",".join(parts) if parts else ""
+
+        lines = []
+        with self._lock:
+            lines.append("# TYPE %s_elapsed_seconds gauge" % prefix)
+            lines.append("%s_elapsed_seconds%s %f" % (prefix, _labels(), time.time() - self.start))
+            for name, value in sorted(self.counters.items()):
+                metric = "%s_%s_total" % (prefix, name)
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s%s %s" % (metric, _labels(), value))
+            for stage, h in sorted(self.histograms.items()):
+                metric = "%s_%s_seconds" % (prefix, stage)
+                lines.append("# TYPE %s histogram" % metric)
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append('%s_bucket%s %d' % (metric, _labels('le="%s"' % le), cumulative))
+                lines.append("%s_sum%s %f" % (metric, _labels(), h.sum))
+                lines.append("%s_count%s %d" % (metric, _labels(), h.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Multi-line human readable summary."""
+        snap = self.snapshot()
+        lines = ["%.1fs elapsed" % snap["elapsed"]]
+        for name, value in sorted(snap["counters"].items()):
+            lines.append("  %-24s %12d  (%.1f/s)" % (name, value, snap["rates"][name]))
+        for stage, s in sorted(snap["stages"].items()):
+            lines.append("  %-24s %8d calls, %8.1fs total, p50 %s p90 %s p99 %s" % (
+                stage, s["count"], s["seconds"],
+                *[_format_seconds(s["p%d" % int(p * 100)]) for p in PERCENTILES]))
+        return "\n".join(lines)
+
+
+def _format_seconds(value):
+    if value is None:
+        return "-"
+    if value < 1:
+        return "%.0fms" % (value * 1000)
+    return "%.2fs" % value
+
+
+def _write_atomic(path, text):
+    ## node_exporter may read the textfile at any time
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class StatsReporter(object):
+    """
+    Every interval seconds, write a snapshot of stats as one JSON line to
+    stats_file (or log it if stats_file is None) and/or rewrite the
+    Prometheus textfile. stop() writes a final snapshot and logs a summary.
+    An output file without an interval is written every DEFAULT_INTERVAL.
+    """
+    def __init__(self, stats, prefix, interval=None, stats_file=None, textfile=None, labels=None):
+        if not interval and (stats_file or textfile):
+            interval = DEFAULT_INTERVAL
+        self.stats = stats
+        self.prefix = prefix
+        self.interval = interval
+        self.stats_file = stats_file
+        self.textfile = textfile
+        self.labels = labels or {}
+        self._stop = threading.Event()
+        self._thread = None
+        if interval:
+            self._thread = threading.Thread(target=self._run, name="stats-reporter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.report()
+            except Exception as e:
+                logging.warning("Failed to write stats: %s" % e)
+
+    def report(self):
+        if self.interval:
+            snap = self.stats.snapshot()
+            snap["time"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+            snap.update(self.labels)
+            line = json.dumps(snap, sort_keys=True)
+            if self.stats_file:
+                with open(self.stats_file, "a") as f:
+                    f.write(line + "\n")
+            else:
+                logging.info("stats " + line)
+        if self.textfile:
+            _write_atomic(self.textfile, self.stats.prometheus_text(self.prefix, self.labels))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.interval or self.textfile:
+            self.report()
+        logging.info("Summary: " + self.stats.summary())
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Text output of field summaries, shared by
+# ogr_value_summary.py and geojson_strip_html.py.
+#
+# String fields list every value with its count, or for
+# sketched summaries the approximate distinct count and
+# the most common values; numeric fields list count,
+# nulls, min, max, mean and quantiles.
+#-------------------------------------------------------
+
+
+def print_layer_summary(layerName, fields):
+    """
+    Print {field: summary dict}, as returned by ogr_value_summary.summarize_layer
+    or geojson_strip_html.strip_html, as text.
+    """
+    print("Layer: " + layerName)
+    print("String Fields:")
+    for field, summary in fields.items():
+        if summary["type"] != "String":
+            continue
+        print("Field: " + field)
+        if "values" in summary:
+            values = summary["values"]
+            for key in sorted(values.keys()):
+                print("'%s': %d" % (key, values[key]))
+            if summary["nulls"]:
+                print("'%s': %d" % (None, summary["nulls"]))
+        else:
+            print("~%d distinct in %d values, %d null" % (
+                summary["distinct"], summary["count"], summary["nulls"]))
+            for key, count in summary["top"]:
+                print("'%s': ~%d" % (key, count))
+        print("\n")
+
+    numeric = [(field, summary) for field, summary in fields.items() if summary["type"] != "String"]
+    if numeric:
+        print("Numeric Fields:")
+    for field, summary in numeric:
+        print("Field: %s (%s)" % (field, summary["type"]))
+        print("count: %d, null: %d, min: %s, max: %s, mean: %s" % (summary["count"],
+            summary["nulls"], summary["min"], summary["max"], summary["mean"]))
+        if summary["quantiles"]:
+            print("quantiles%s: %s" % ("" if summary["exact"] else " (sampled)",
+                ", ".join("%s: %s" % item for item in summary["quantiles"].items())))
+        print("\n")
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Minimal MBTiles (SQLite) tile storage.
+#
+# https://github.com/mapbox/mbtiles-spec
+#
+# MBTiles stores rows in TMS order, so y is flipped relative
+# to the OSM/google scheme used everywhere else in these tools
+# (the same flip `tilenames.py --flip-y` computes).
+#
+# A deduplicated file stores each distinct tile image once
+# in an images table, keyed by its md5, with a map table
+# from z/x/y to image and a tiles view joining the two, as
+# written by tools such as mbutil and tilelive. Images no
+# longer referenced after a tile is replaced are deleted
+# when the writer closes.
+#-------------------------------------------------------
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def flip_y(y, z):
+    return (2 ** z) - y - 1
+
+
+def is_mbtiles(path):
+    return path.lower().endswith(".mbtiles")
+
+
+def _create_schema(conn, dedup=False):
+    conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+    ## an existing file keeps the layout it was created with
+    if dedup and not _has_table(conn, "tiles"):
+        conn.execute("CREATE TABLE IF NOT EXISTS map ("
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS map_index "
+            "ON map (zoom_level, tile_column, tile_row)")
+        conn.execute("CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB)")
+        conn.execute("CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, "
+            "map.tile_column AS tile_column, map.tile_row AS tile_row, images.tile_data AS tile_data "
+            "FROM map JOIN images ON images.tile_id = map.tile_id")
+    elif not is_deduplicated(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS tiles ("
+            "zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index "
+            "ON tiles (zoom_level, tile_column, tile_row)")
+    conn.commit()
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (name,)).fetchone() is not None
+
+
+def is_deduplicated(conn):
+    """True if the file uses the map/images layout."""
+    return _has_table(conn, "map") and _has_table(conn, "images")
+
+
+def dedup_report(path):
+    """
+    Return (tiles, unique images, bytes if stored per tile, bytes stored)
+    for an MBTiles file. Without the map/images layout every tile is unique.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        if is_deduplicated(conn):
+            tiles, logical = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(images.tile_data)), 0) "
+                "FROM map JOIN images ON images.tile_id = map.tile_id").fetchone()
+            unique, stored = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM images").fetchone()
+        else:
+            tiles, logical = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(tile_data)), 0) FROM tiles").fetchone()
+            unique, stored = tiles, logical
+        return tiles, unique, logical, stored
+    finally:
+        conn.close()
+
+
+def existing_tiles(path, zoom):
+    """
+    Return the set of (x, y) tiles, in OSM/google order, stored at zoom.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        table = "map" if is_deduplicated(conn) else "tiles"
+        rows = conn.execute("SELECT tile_column, tile_row FROM %s WHERE zoom_level = ?" % table, (zoom,))
+        return set((x, flip_y(row, zoom)) for x, row in rows)
+    finally:
+        conn.close()
+
+
+def orphaned_tiles(path, zoom):
+    """
+    Return the set of (x, y) tiles, in OSM/google order, stored at zoom
+    whose parent at zoom - 1 is not stored. Halving a TMS row gives the
+    parent's TMS row, so this is one anti-join on the tile index.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        table = "map" if is_deduplicated(conn) else "tiles"
+        rows = conn.execute("SELECT c.tile_column, c.tile_row FROM %s c "
+            "WHERE c.zoom_level = ? AND NOT EXISTS (SELECT 1 FROM %s p "
+            "WHERE p.zoom_level = ? AND p.tile_column = c.tile_column / 2 "
+            "AND p.tile_row = c.tile_row / 2)" % (table, table), (zoom, zoom - 1))
+        return set((x, flip_y(row, zoom)) for x, row in rows)
+    finally:
+        conn.close()
+
+
+class MBTilesWriter(object):
+    """
+    Single writer thread for an MBTiles file. Any number of threads can
+    put() tiles; they are queued and inserted in batched transactions, so
+    SQLite only ever sees one writing connection.
+
+    on_commit, if given, is called from the writer thread with the list of
+    (tile, data, info) tuples after each batch is durably committed; info is
+    whatever the producer passed to put().
+
+    With dedup a new file is created with the map/images layout, so
+    identical tiles (open ocean, blank land) are stored once. An existing
+    file keeps its layout.
+    """
+    def __init__(self, path, metadata=None, batch_size=DEFAULT_BATCH_SIZE, on_commit=None,
+            dedup=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self._queue = queue.Queue(maxsize=batch_size * 4)
+        self._error = None
+        ## image ids that replaced tiles pointed to, pruned on close
+        self._replaced = set()
+
+        conn = sqlite3.connect(path)
+        _create_schema(conn, dedup)
+        self.dedup = is_deduplicated(conn)
+        if metadata:
+            conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                [(k, str(v)) for k, v in metadata.items()])
+            conn.commit()
+        conn.close()
+
+        self._thread = threading.Thread(target=self._run, name="mbtiles-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, tile, data, info=None):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((tile, data, info))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        batch = []
+        done = False
+        try:
+            while not done:
+                try:
+                    item = self._queue.get(timeout=1 if batch else None)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    done = True
+                elif item is not False:
+                    batch.append(item)
+                if batch and (done or item is False or len(batch) >= self.batch_size):
+                    self._commit(conn, batch)
+                    batch = []
+            if self._replaced:
+                self._prune_images(conn)
+        except Exception as e:
+            logging.error("MBTiles writer failed: %s" % e)
+            self._error = e
+            ## keep draining so producers blocked on put() are released
+            while not done and self._queue.get() is not None:
+                pass
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        with conn:
+            if self.dedup:
+                ids = [hashlib.md5(data).hexdigest() for _, data, _ in batch]
+                for tile_id, (t, _, _) in zip(ids, batch):
+                    row = conn.execute("SELECT tile_id FROM map WHERE zoom_level = ? "
+                        "AND tile_column = ? AND tile_row = ?", (t.z, t.x, flip_y(t.y, t.z))).fetchone()
+                    if row is not None and row[0] != tile_id:
+                        self._replaced.add(row[0])
+                conn.executemany("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)",
+                    [(tile_id, sqlite3.Binary(data)) for tile_id, (_, data, _) in zip(ids, batch)])
+                conn.executemany("INSERT OR REPLACE INTO map "
+                    "(zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                    [(t.z, t.x, flip_y(t.y, t.z), tile_id) for tile_id, (t, _, _) in zip(ids, batch)])
+            else:
+                conn.executemany("INSERT OR REPLACE INTO tiles "
+                    "(zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                    [(t.z, t.x, flip_y(t.y, t.z), sqlite3.Binary(data)) for t, data, _ in batch])
+        if self.on_commit is not None:
+            self.on_commit(batch)
+
+    def _prune_images(self, conn):
+        """Delete images that replaced tiles used and no tile uses any more."""
+        with conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS replaced (tile_id TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO replaced (tile_id) VALUES (?)",
+                [(tile_id,) for tile_id in self._replaced])
+            deleted = conn.execute("DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM replaced) "
+                "AND tile_id NOT IN (SELECT tile_id FROM map)").rowcount
+            conn.execute("DELETE FROM replaced")
+        logging.debug("Pruned %d unreferenced images" % deleted)
+        self._replaced = set()
@@ -1,57 +1,219 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import logging
 from optparse import OptionParser
-import os
+import json
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from osgeo import ogr
 
-def log_file_fields(filename):
-    print("File: " + filename)
+from layer_summary import print_layer_summary
+from sketches import ExactCounts, StringSketch, QuantileSample, \
+    DEFAULT_PRECISION, DEFAULT_TOP_K, DEFAULT_SAMPLE_SIZE
+
+ogr.UseExceptions()
+
+NUMERIC_TYPES = ("Integer", "Integer64", "Real")
+## Features buffered per update when not reading Arrow batches
+BATCH_SIZE = 10000
+
+def _summary_fields(layer):
+    """(name, type name) of the string and numeric fields of a layer."""
+    fields = []
+    layerDefinition = layer.GetLayerDefn()
+    for n in range(layerDefinition.GetFieldCount()):
+        fieldDefinition = layerDefinition.GetFieldDefn(n)
+        fieldName =  fieldDefinition.GetName()
+        fieldTypeCode = fieldDefinition.GetType()
+        fieldType = fieldDefinition.GetFieldTypeName(fieldTypeCode)
+        if fieldType == "String" or fieldType in NUMERIC_TYPES:
+            fields.append((fieldName, fieldType))
+    return fields
+
+
+def _ignore_other_fields(layer, fields):
+    """Skip decoding geometry and unused fields while reading."""
+    layerDefinition = layer.GetLayerDefn()
+    ignored = [layerDefinition.GetFieldDefn(n).GetName()
+        for n in range(layerDefinition.GetFieldCount())]
+    ignored = [name for name in ignored if name not in fields]
+    layer.SetIgnoredFields(ignored + ["OGR_GEOMETRY", "OGR_STYLE"])
+
+
+def _value_counts(values):
+    """Counter of a column's values, with bytes from Arrow batches decoded."""
+    counts = Counter(values)
+    if any(isinstance(value, bytes) for value in counts):
+        decoded = Counter()
+        for value, count in counts.items():
+            if isinstance(value, bytes):
+                value = value.decode('utf-8', 'replace')
+            decoded[value] += count
+        counts = decoded
+    return counts
+
+
+def _update(summaries, columns):
+    for field, (fieldType, summary) in summaries.items():
+        if fieldType == "String":
+            summary.update(_value_counts(columns[field]))
+        else:
+            summary.update(columns[field])
+
+
+def _column_values(column):
+    """
+    Values of an Arrow batch column as a list, with None for nulls as
+    GetField returns them. Columns with nulls are masked arrays, whose mask
+    is the batch's validity bitmap; plain tolist() on their data would
+    count a null number as 0.
+    """
+    if hasattr(column, "mask"):
+        return column.tolist(fill_value=None)
+    return column.tolist()
+
+
+def _read_arrow(layer, summaries):
+    """Read record batches (GDAL >= 3.6) and update summaries a column at a time."""
+    stream = layer.GetArrowStreamAsNumPy(options=["INCLUDE_FID=NO", "USE_MASKED_ARRAYS=YES"])
+    for batch in stream:
+        _update(summaries, dict((field, _column_values(batch[field])) for field in summaries))
+
+
+def _read_features(layer, summaries):
+    defn = layer.GetLayerDefn()
+    indexes = [(field, defn.GetFieldIndex(field)) for field in summaries]
+    layer.ResetReading()
+    columns = dict((field, []) for field in summaries)
+    for feature in layer:
+        for field, index in indexes:
+            columns[field].append(feature.GetField(index))
+        if len(columns[indexes[0][0]]) >= BATCH_SIZE:
+            _update(summaries, columns)
+            columns = dict((field, []) for field in summaries)
+    _update(summaries, columns)
+
+
+def summarize_layer(filename, layer_index, use_arrow=True, approximate=False,
+        precision=DEFAULT_PRECISION, top_k=DEFAULT_TOP_K, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Summarize every string and numeric field of a layer in a single pass.
+    String fields get exact value counts, or with approximate a
+    HyperLogLog distinct count and top_k values; numeric fields get
+    min/max/mean and quantiles from a sample of sample_size values.
+    Returns the layer name and a {field: summary dict} in field order.
+    """
     source = ogr.Open(filename)
+    layer = source.GetLayerByIndex(layer_index)
+    summaries = {}
+    for field, fieldType in _summary_fields(layer):
+        if fieldType != "String":
+            summary = QuantileSample(sample_size)
+        elif approximate:
+            summary = StringSketch(precision, top_k)
+        else:
+            summary = ExactCounts()
+        summaries[field] = (fieldType, summary)
+    if summaries:
+        _ignore_other_fields(layer, summaries)
+        if use_arrow and hasattr(layer, "GetArrowStreamAsNumPy"):
+            _read_arrow(layer, summaries)
+        else:
+            _read_features(layer, summaries)
+
+    result = {}
+    for field, (fieldType, summary) in summaries.items():
+        result[field] = summary.summary()
+        result[field]["type"] = fieldType
+    return layer.GetName(), result
+
 
+def _summarize_job(job):
+    filename, layer_index, kwargs = job
+    return filename, summarize_layer(filename, layer_index, **kwargs)
+
+
+def log_file_fields(filename, **kwargs):
+    print("File: " + filename)
+    source = ogr.Open(filename)
     for i in range(source.GetLayerCount()):
-        layer = source.GetLayerByIndex(i)
-        layerName = layer.GetName()
-        print("Layer: " + layerName)
-        stringFields = []
-        layerDefinition = layer.GetLayerDefn()
-        for n in range(layerDefinition.GetFieldCount()):
-            fieldDefinition = layerDefinition.GetFieldDefn(n)
-            fieldName =  fieldDefinition.GetName()
-            fieldTypeCode = fieldDefinition.GetType()
-            fieldType = fieldDefinition.GetFieldTypeName(fieldTypeCode)
-            if fieldType == "String":
-                stringFields.append(fieldName)
-    
-        print("String Fields:")
-        for field in stringFields:
-            sql = 'SELECT %s FROM %s' % (field, layerName)
-            fieldLayer = source.ExecuteSQL(sql)
-            values = {}
-            for i, feature in enumerate(fieldLayer):
-                values[feature.GetField(0)] = values.get(feature.GetField(0), 0) + 1
-        
-            print("Field: " + field)
-            for key in sorted(values.keys()):
-                print("'%s': %d" % (key, values[key]))
-            print("\n")
+        print_layer_summary(*summarize_layer(filename, i, **kwargs))
+
+
+def iter_summaries(filenames, processes=None, **kwargs):
+    """
+    Yield (filename, layer name, fields) for every layer of every file,
+    summarized one layer per pool task, in file and layer order.
+    """
+    jobs = []
+    for filename in filenames:
+        source = ogr.Open(filename)
+        jobs.extend((filename, i, kwargs) for i in range(source.GetLayerCount()))
+        source = None
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for filename, (layerName, fields) in pool.map(_summarize_job, jobs):
+            yield filename, layerName, fields
+
+
+def summarize_files(filenames, processes=None, **kwargs):
+    last_filename = None
+    for filename, layerName, fields in iter_summaries(filenames, processes, **kwargs):
+        if filename != last_filename:
+            print("File: " + filename)
+            last_filename = filename
+        print_layer_summary(layerName, fields)
+
+
+def _json_summary(filenames, processes=None, **kwargs):
+    """One document keyed by file, layer and field, for diffing releases."""
+    files = {}
+    for filename, layerName, fields in iter_summaries(filenames, processes, **kwargs):
+        for summary in fields.values():
+            if "values" in summary:
+                ## JSON keys must be strings; nulls are counted separately
+                summary["values"] = dict((str(k), v) for k, v in summary["values"].items())
+        files.setdefault(filename, {})[layerName] = fields
+    return files
 
 def _main():
-    usage = "usage: %prog"
+    usage = "usage: %prog [options] file [file ...]"
     parser = OptionParser(usage=usage,
-                          description="")
+                          description="Summarize the values of the string and numeric fields in each layer")
     parser.add_option("-d", "--debug", action="store_true", dest="debug",
                       help="Turn on debug logging")
     parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
                       help="turn off all logging")
+    parser.add_option("-p", "--processes", action="store", type="int", dest="processes",
+                      help="Number of worker processes, each summarizing one layer (default: one per CPU)")
+    parser.add_option("--no-arrow", action="store_false", dest="use_arrow", default=True,
+                      help="Read features one at a time instead of as Arrow record batches")
+    parser.add_option("-a", "--approximate", action="store_true", dest="approximate",
+                      help="Summarize string fields with bounded-memory sketches: an approximate "
+                      "distinct count and the most common values")
+    parser.add_option("--precision", action="store", type="int", dest="precision",
+                      default=DEFAULT_PRECISION,
+                      help="HyperLogLog precision; each field uses 2^precision bytes (default %default)")
+    parser.add_option("-k", "--top-k", action="store", type="int", dest="top_k",
+                      default=DEFAULT_TOP_K, help="Most common values to report (default %default)")
+    parser.add_option("--sample-size", action="store", type="int", dest="sample_size",
+                      default=DEFAULT_SAMPLE_SIZE,
+                      help="Values sampled per numeric field for quantiles (default %default)")
+    parser.add_option("-j", "--json", action="store_true", dest="json",
+                      help="Print a JSON document instead of text")
 
     (options, args) = parser.parse_args()
- 
+
     logging.basicConfig(level=logging.DEBUG if options.debug else
     (logging.ERROR if options.quiet else logging.INFO))
 
-    for arg in args:
-        log_file_fields(arg)
+    kwargs = dict(use_arrow=options.use_arrow, approximate=options.approximate,
+        precision=options.precision, top_k=options.top_k, sample_size=options.sample_size)
+    if options.json:
+        print(json.dumps(_json_summary(args, options.processes, **kwargs), sort_keys=True,
+            indent=4, separators=(',', ': ')))
+    else:
+        summarize_files(args, options.processes, **kwargs)
 
 if __name__ == "__main__":
-    _main()
\ No newline at end of file
+    _main()
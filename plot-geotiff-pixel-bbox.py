@@ -5,10 +5,17 @@
 # when geo-referencing or creating/testing cutlines.
 ################################################################
 import argparse
+import csv
+import json
 import logging
+import math
 import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import rasterio
 from rasterio import windows
+from rasterio.enums import Resampling
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 
@@ -16,41 +23,241 @@ logging.basicConfig(format='%(message)s', level=logging.INFO)
 logger = logging.getLogger()
 
 
+## Fraction of the bbox size added on each side of the inset window
+DEFAULT_INSET_PAD = 0.5
+## Minimum padding in pixels, so tiny bboxes still show their surroundings
+MIN_INSET_PAD = 16
+## Bboxes on one raster rendered by a batch task, sharing one open dataset
+BATCH_JOBS_PER_TASK = 32
+
+
+def _out_shape(height, width, max_pixels):
+    """Shape of a read decimated so the long side is at most max_pixels."""
+    factor = max(1, int(math.ceil(max(height, width) / float(max_pixels))))
+    return int(math.ceil(height / float(factor))), int(math.ceil(width / float(factor)))
+
+
+def read_decimated(raster_src, max_pixels, window=None):
+    """
+    Read band 1, or a window of it, at no more than max_pixels on the long
+    side. GDAL serves decimated reads from overviews when the file has
+    them, so memory and I/O scale with the plot, not the raster.
+    """
+    if window is None:
+        height, width = raster_src.height, raster_src.width
+    else:
+        height, width = int(window.height), int(window.width)
+    return raster_src.read(1, window=window, out_shape=_out_shape(height, width, max_pixels),
+                           resampling=Resampling.nearest)
+
+
+def _bbox_patch(window_slice, bbox_color):
+    return Rectangle(
+        (window_slice.col_off, window_slice.row_off),
+        width=window_slice.width,
+        height=window_slice.height,
+        fill=True,
+        alpha=.5,
+        color=bbox_color
+    )
+
+
+def _inset_window(raster_src, window_slice, pad):
+    pad_x = max(window_slice.width * pad, MIN_INSET_PAD)
+    pad_y = max(window_slice.height * pad, MIN_INSET_PAD)
+    col_off = max(0, int(window_slice.col_off - pad_x))
+    row_off = max(0, int(window_slice.row_off - pad_y))
+    col_end = min(raster_src.width, int(math.ceil(window_slice.col_off + window_slice.width + pad_x)))
+    row_end = min(raster_src.height, int(math.ceil(window_slice.row_off + window_slice.height + pad_y)))
+    return windows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def max_plot_pixels(dpi=None):
+    """Pixels along the long side of a default-sized figure at dpi."""
+    dpi = dpi or plt.rcParams['figure.dpi']
+    return int(max(plt.rcParams['figure.figsize']) * dpi)
+
+
+def plot_bbox(raster_src, title, window_slice, bbox_color='red', dpi=None, inset=True,
+              inset_pad=DEFAULT_INSET_PAD, overview=None):
+    """
+    Return a figure of band 1 with window_slice highlighted, plus a zoomed
+    inset of the area around it. Pixels are read at the resolution the
+    figure will be drawn at, never the full raster. overview, if given, is
+    a read_decimated array to reuse for several bboxes on one raster.
+    """
+    fig = plt.figure()
+    max_pixels = max_plot_pixels(dpi)
+    if overview is None:
+        overview = read_decimated(raster_src, max_pixels)
+
+    ax = fig.gca()
+    ## extent keeps the axes in full-resolution pixel coordinates
+    image = ax.imshow(overview,
+                      extent=(0, raster_src.width, raster_src.height, 0))
+    ax.set_title(title)
+    ax.add_patch(_bbox_patch(window_slice, bbox_color))
+
+    if inset:
+        inset_window = _inset_window(raster_src, window_slice, inset_pad)
+        if inset_window.width > 0 and inset_window.height > 0:
+            inset_ax = ax.inset_axes([0.6, 0.6, 0.38, 0.38])
+            inset_ax.imshow(read_decimated(raster_src, max_pixels // 2, inset_window),
+                            extent=(inset_window.col_off, inset_window.col_off + inset_window.width,
+                                    inset_window.row_off + inset_window.height, inset_window.row_off),
+                            norm=image.norm)
+            inset_ax.add_patch(_bbox_patch(window_slice, bbox_color))
+            inset_ax.set_xticks([])
+            inset_ax.set_yticks([])
+            ax.indicate_inset_zoom(inset_ax)
+    return fig
+
+
+def _pixel_window(ll, ur):
+    """Window for lower left and upper right 'x,y' pixel coordinates."""
+    min_x, max_y = [int(v) for v in ll.split(',')]
+    max_x, min_y = [int(v) for v in ur.split(',')]
+    slice_raster = (slice(min_y, max_y), slice(min_x, max_x))
+    return windows.Window.from_slices(*slice_raster)
+
+
+def read_jobs(path):
+    """
+    Read batch jobs from a CSV file with a header, or a JSON list of
+    objects. Each job has raster, lower_left and upper_right ('x,y'
+    strings, or [x, y] in JSON), and optionally output and bbox_color.
+    """
+    with open(path) as f:
+        if path.lower().endswith('.json'):
+            jobs = json.load(f)
+        else:
+            jobs = list(csv.DictReader(f))
+    for job in jobs:
+        for key in ('lower_left', 'upper_right'):
+            if isinstance(job[key], (list, tuple)):
+                job[key] = '%d,%d' % tuple(job[key])
+    return jobs
+
+
+def _job_output(job, outdir):
+    if job.get('output'):
+        return os.path.normpath(os.path.join(outdir, job['output']))
+    stem = os.path.splitext(os.path.basename(job['raster']))[0]
+    name = '%s_%s_%s.png' % (stem, job['lower_left'].replace(',', '-'), job['upper_right'].replace(',', '-'))
+    return os.path.normpath(os.path.join(outdir, name))
+
+
+def assign_outputs(jobs, outdir):
+    """
+    Set each job's output_path. A generated name shared with another job
+    (rasters with the same file name in different directories, or a
+    repeated bbox) gets the job's index appended; an explicit output
+    shared by two jobs is an error.
+    """
+    names = [_job_output(job, outdir) for job in jobs]
+    explicit = Counter(name for job, name in zip(jobs, names) if job.get('output'))
+    duplicates = [name for name, count in explicit.items() if count > 1]
+    if duplicates:
+        raise SystemExit('More than one job writes %s' % ', '.join(sorted(duplicates)))
+    counts = Counter(names)
+    for i, (job, name) in enumerate(zip(jobs, names)):
+        if counts[name] > 1 and not job.get('output'):
+            root, ext = os.path.splitext(name)
+            name = '%s_%d%s' % (root, i, ext)
+        job['output_path'] = name
+
+
+def _init_batch_worker():
+    plt.switch_backend('Agg')
+
+
+def render_jobs(src_file, jobs, dpi, bbox_color='red', inset=True, inset_pad=DEFAULT_INSET_PAD):
+    """
+    Render jobs that all target src_file to their output_path (see
+    assign_outputs), opening it and reading its decimated overview once.
+    Returns (output, error) for each job.
+    """
+    results = []
+    try:
+        with rasterio.open(src_file) as raster_src:
+            overview = read_decimated(raster_src, max_plot_pixels(dpi))
+            for job in jobs:
+                output = job['output_path']
+                try:
+                    fig = plot_bbox(raster_src, os.path.basename(src_file),
+                                    _pixel_window(job['lower_left'], job['upper_right']),
+                                    job.get('bbox_color') or bbox_color, dpi=dpi, inset=inset,
+                                    inset_pad=inset_pad, overview=overview)
+                    fig.savefig(output, dpi=dpi)
+                    plt.close(fig)
+                    results.append((output, None))
+                except Exception as e:
+                    plt.close('all')
+                    results.append((output, str(e)))
+    except Exception as e:
+        results.extend((job['output_path'], str(e)) for job in jobs[len(results):])
+    return results
+
+
+def run_batch(args):
+    """Render every job in args.batch to PNGs with a process pool."""
+    jobs = read_jobs(args.batch)
+    outdir = args.outdir or '.'
+    assign_outputs(jobs, outdir)
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    dpi = args.png_dpi or 300
+    _init_batch_worker()
+
+    ## group by raster so each dataset is opened once per task
+    by_raster = {}
+    for job in jobs:
+        by_raster.setdefault(job['raster'], []).append(job)
+    tasks = []
+    for src_file, raster_jobs in by_raster.items():
+        for i in range(0, len(raster_jobs), BATCH_JOBS_PER_TASK):
+            tasks.append((src_file, raster_jobs[i:i + BATCH_JOBS_PER_TASK]))
+
+    logging.info('Rendering %d bboxes on %d rasters' % (len(jobs), len(by_raster)))
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.processes, initializer=_init_batch_worker) as pool:
+        futures = [pool.submit(render_jobs, src_file, task_jobs, dpi, args.bbox_color,
+                               not args.no_inset, args.inset_pad) for src_file, task_jobs in tasks]
+        for future in as_completed(futures):
+            for output, error in future.result():
+                if error:
+                    failed += 1
+                    logging.error('Failed to render %s: %s' % (output, error))
+                else:
+                    logging.debug('Exported ' + output)
+    logging.info('Rendered %d of %d bboxes' % (len(jobs) - failed, len(jobs)))
+    if failed:
+        sys.exit(1)
+
+
 def run(args):
+    if args.batch:
+        return run_batch(args)
+    if not args.src:
+        raise SystemExit('-s or -batch is required')
     src_file = args.src
-    min_x = int(args.ll.split(',')[0])
-    max_x = int(args.ur.split(',')[0])
-    min_y = int(args.ur.split(',')[1])
-    max_y = int(args.ll.split(',')[1])
     bbox_color = args.bbox_color
     output = args.output
     png_dpi = args.png_dpi
 
     logging.info('Reading band 1 from ' + src_file)
-    raster_src = rasterio.open(src_file)
+    with rasterio.open(src_file) as raster_src:
+        logging.info('Building overlay')
+        window_slice = _pixel_window(args.ll, args.ur)
 
-    logging.info('Building overlay')
-    slice_raster = (slice(min_y, max_y), slice(min_x, max_x))
-    window_slice = windows.Window.from_slices(*slice_raster)
-
-    plt.imshow(raster_src.read(1))
-    plt.title(os.path.basename(src_file))
-    ax = plt.gca()
-    ax.add_patch(
-        Rectangle(
-            (window_slice.col_off, window_slice.row_off),
-            width=window_slice.width,
-            height=window_slice.height,
-            fill=True,
-            alpha=.5,
-            color=bbox_color
-        )
-    )
+        if output and not png_dpi:
+            png_dpi = 300
+        plot_bbox(raster_src, os.path.basename(src_file), window_slice, bbox_color,
+                  dpi=png_dpi if output else None, inset=not args.no_inset,
+                  inset_pad=args.inset_pad)
 
     if output:
         logging.info('Exporting ' + output)
-        if not png_dpi:
-            png_dpi = 300
         plt.savefig(output, dpi=png_dpi)
     else:
         plt.show()
@@ -58,12 +265,18 @@ def run(args):
 
 def main():
     parser = argparse.ArgumentParser(description='Plots GeoTiff with a pixel value bbox overlay')
-    parser.add_argument('-s', help='Filepath to raster', dest='src', required=True)
+    parser.add_argument('-s', help='Filepath to raster', dest='src', required=False)
     parser.add_argument('-lower_left', help='Lower Left corner pixel coordinates', dest='ll', default='1,100', required=False)
     parser.add_argument('-upper_right', help='Upper Right corner pixel coordinates', dest='ur', default='100,1', required=False)
     parser.add_argument('-bbox_color', help='Color of bounding box overlay', dest='bbox_color', default='red', required=False)
     parser.add_argument('-o', help='Export plot as a PNG', dest='output', required=False)
     parser.add_argument('-dpi', help='PNG export DPI, default is 300 DPI', dest='png_dpi', type=int, required=False)
+    parser.add_argument('-no_inset', help='Do not draw a zoomed inset around the bbox', dest='no_inset', action='store_true')
+    parser.add_argument('-inset_pad', help='Inset padding around the bbox, as a fraction of its size, default is %s' % DEFAULT_INSET_PAD,
+                        dest='inset_pad', type=float, default=DEFAULT_INSET_PAD, required=False)
+    parser.add_argument('-batch', help='CSV or JSON file of raster,lower_left,upper_right[,output] jobs to render as PNGs', dest='batch', required=False)
+    parser.add_argument('-outdir', help='Directory for batch PNGs, default is the current directory', dest='outdir', required=False)
+    parser.add_argument('-processes', help='Batch worker processes, default is one per CPU', dest='processes', type=int, required=False)
     parser.set_defaults(func=run)
     args = parser.parse_args()
     args.func(args)
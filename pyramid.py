@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Builds lower zoom tiles from higher zoom tiles.
+#
+# Each parent tile is the 2x2 mosaic of its four children
+# downsampled by half, so only the maximum zoom has to be
+# fetched from upstream. Levels are built bottom-up, and
+# only parents with a changed child are rebuilt:
+#
+#  - download_tiles passes in the tiles it wrote;
+#  - otherwise, in a z/x/y.png tree a parent is stale if
+#    it is missing or older than any of its children, and
+#    in MBTiles every parent is rebuilt.
+#
+# Hardlinked duplicates (dedup.py) share the mtime of the
+# first copy of their content, so mtimes can miss stale
+# parents in a deduplicated tree; pass the changed tiles.
+#
+# Parents are built in a process pool, a few dozen per
+# task so each worker amortizes its imports and I/O.
+#-------------------------------------------------------
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+import mercantile
+from PIL import Image
+
+import dedup as dedup_store
+import mbtiles
+
+TILE_SIZE = 256
+PARENTS_PER_TASK = 64
+
+
+def downsample(children, tile_size=TILE_SIZE):
+    """
+    Build a parent tile from {(dx, dy): image bytes} of its children, where
+    dx, dy are 0 or 1. Missing children, e.g. outside the downloaded area,
+    are left transparent. Returns PNG bytes, or None if no child exists.
+    """
+    if not children:
+        return None
+    mosaic = Image.new("RGBa", (tile_size * 2, tile_size * 2))
+    for (dx, dy), data in children.items():
+        child = Image.open(io.BytesIO(data)).convert("RGBA")
+        if child.size != (tile_size, tile_size):
+            child = child.resize((tile_size, tile_size))
+        ## premultiplied alpha, so transparent pixels do not darken edges
+        mosaic.paste(child.convert("RGBa"), (dx * tile_size, dy * tile_size))
+    parent = mosaic.reduce(2).convert("RGBA")
+    out = io.BytesIO()
+    parent.save(out, "PNG", optimize=False)
+    return out.getvalue()
+
+
+def _child_offsets(parent):
+    for child in mercantile.children(parent):
+        yield child, (child.x - parent.x * 2, child.y - parent.y * 2)
+
+
+def _tile_path(path, tile):
+    return os.path.join(path, str(tile.z), str(tile.x), str(tile.y) + ".png")
+
+
+def _build_dir_parents(path, parents, tile_size, dedup=False):
+    """Process pool worker: write the given parents into a z/x/y.png tree."""
+    built = []
+    for parent in parents:
+        children = {}
+        for child, offset in _child_offsets(parent):
+            try:
+                with open(_tile_path(path, child), "rb") as f:
+                    children[offset] = f.read()
+            except FileNotFoundError:
+                continue
+        data = downsample(children, tile_size)
+        if data is None:
+            continue
+        file_path = _tile_path(path, parent)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (file_path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, file_path)
+        if dedup:
+            dedup_store.link_duplicate(path, file_path, hashlib.md5(data).hexdigest())
+        built.append(parent)
+    return built
+
+
+def _build_mbtiles_parents(path, parents, tile_size):
+    """Process pool worker: return (parent, data) for the given parents."""
+    conn = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+    built = []
+    try:
+        for parent in parents:
+            children = {}
+            for child, offset in _child_offsets(parent):
+                row = conn.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? "
+                    "AND tile_column = ? AND tile_row = ?",
+                    (child.z, child.x, mbtiles.flip_y(child.y, child.z))).fetchone()
+                if row is not None:
+                    children[offset] = bytes(row[0])
+            data = downsample(children, tile_size)
+            if data is not None:
+                built.append((parent, data))
+    finally:
+        conn.close()
+    return built
+
+
+def _stale_dir_parents(path, zoom):
+    """Parents at zoom - 1 that are missing or older than a child at zoom."""
+    stale = set()
+    zoom_dir = os.path.join(path, str(zoom))
+    if not os.path.isdir(zoom_dir):
+        return stale
+    parent_mtimes = {}
+    for x_entry in os.scandir(zoom_dir):
+        if not x_entry.is_dir() or not x_entry.name.isdigit():
+            continue
+        for y_entry in os.scandir(x_entry.path):
+            name, ext = os.path.splitext(y_entry.name)
+            if ext != ".png" or not name.isdigit():
+                continue
+            parent = mercantile.parent(mercantile.Tile(int(x_entry.name), int(name), zoom))
+            if parent in stale:
+                continue
+            if parent not in parent_mtimes:
+                try:
+                    parent_mtimes[parent] = os.stat(_tile_path(path, parent)).st_mtime
+                except FileNotFoundError:
+                    parent_mtimes[parent] = None
+            if parent_mtimes[parent] is None or y_entry.stat().st_mtime > parent_mtimes[parent]:
+                stale.add(parent)
+    return stale
+
+
+def _mbtiles_tiles(path, zoom):
+    return set(mercantile.Tile(x, y, zoom) for x, y in mbtiles.existing_tiles(path, zoom))
+
+
+def _dir_tiles(path, zoom):
+    tiles = set()
+    zoom_dir = os.path.join(path, str(zoom))
+    if not os.path.isdir(zoom_dir):
+        return tiles
+    for x_entry in os.scandir(zoom_dir):
+        if not x_entry.is_dir() or not x_entry.name.isdigit():
+            continue
+        for y_entry in os.scandir(x_entry.path):
+            name, ext = os.path.splitext(y_entry.name)
+            if ext == ".png" and name.isdigit():
+                tiles.add(mercantile.Tile(int(x_entry.name), int(name), zoom))
+    return tiles
+
+
+def orphaned_tiles(path, zoom):
+    """
+    Tiles at zoom whose parent does not exist, e.g. written by a run that
+    stopped before building the pyramid. This reads every tile at zoom and
+    zoom - 1, so it is not part of an incremental build.
+    """
+    if zoom == 0:
+        return set()
+    if mbtiles.is_mbtiles(path):
+        return set(mercantile.Tile(x, y, zoom) for x, y in mbtiles.orphaned_tiles(path, zoom))
+    parents = _dir_tiles(path, zoom - 1)
+    return set(tile for tile in _dir_tiles(path, zoom) if mercantile.parent(tile) not in parents)
+
+
+def _chunks(tiles, size):
+    tiles = sorted(tiles)
+    for i in range(0, len(tiles), size):
+        yield tiles[i:i + size]
+
+
+def build_pyramid(path, maxzoom, minzoom=0, changed=None, processes=None, tile_size=TILE_SIZE,
+        dedup=False):
+    """
+    Build zooms maxzoom - 1 down to minzoom of the tile tree or MBTiles file
+    at path from the tiles at maxzoom. changed, if given, is the set of
+    maxzoom tiles that changed; only their ancestors are rebuilt. dedup
+    hardlinks identical tiles in a tree; MBTiles files keep their layout.
+    Returns the number of tiles built.
+    """
+    to_mbtiles = mbtiles.is_mbtiles(path)
+    total = 0
+    ## spawn, not fork: the MBTiles writer and download threads may hold locks
+    with ProcessPoolExecutor(max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn")) as pool:
+        for zoom in range(maxzoom, minzoom, -1):
+            if changed is not None:
+                parents = set(mercantile.parent(tile) for tile in changed if tile.z == zoom)
+            elif to_mbtiles:
+                parents = set(mercantile.parent(tile) for tile in _mbtiles_tiles(path, zoom))
+            else:
+                parents = _stale_dir_parents(path, zoom)
+            logging.info("Building %d tiles for zoom %d" % (len(parents), zoom - 1))
+
+            built = []
+            if to_mbtiles:
+                writer = mbtiles.MBTilesWriter(path)
+                try:
+                    futures = [pool.submit(_build_mbtiles_parents, path, chunk, tile_size)
+                        for chunk in _chunks(parents, PARENTS_PER_TASK)]
+                    for future in futures:
+                        for parent, data in future.result():
+                            writer.put(parent, data)
+                            built.append(parent)
+                finally:
+                    ## the next level reads these parents back
+                    writer.close()
+            else:
+                futures = [pool.submit(_build_dir_parents, path, chunk, tile_size, dedup)
+                    for chunk in _chunks(parents, PARENTS_PER_TASK)]
+                for future in futures:
+                    built.extend(future.result())
+            total += len(built)
+            if changed is not None:
+                changed = built
+    return total
+
+
+def _main():
+    usage = "usage: %prog [options] PATH"
+    parser = OptionParser(usage=usage,
+                          description="Build lower zoom levels of a z/x/y.png tile tree or an MBTiles "
+                          "file by downsampling the tiles at the maximum zoom")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug",
+                      help="Turn on debug logging")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
+                      help="turn off all logging")
+    parser.add_option("-z", "--min-zoom", action="store", type="int",
+        dest="min_zoom", default=0)
+    parser.add_option("-Z", "--max-zoom", action="store", type="int",
+        dest="max_zoom", default=15, help="Zoom of the source tiles (default %default)")
+    parser.add_option("-p", "--processes", action="store", type="int", dest="processes",
+        help="Number of worker processes (default: one per CPU)")
+    parser.add_option("-D", "--dedup", action="store_true", dest="dedup", default=False,
+        help="Hardlink identical tiles in a tile tree to one content-addressed copy")
+    parser.add_option("--tile-size", action="store", type="int", dest="tile_size",
+        default=TILE_SIZE, help="Tile size in pixels (default %default)")
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else
+    (logging.ERROR if options.quiet else logging.INFO))
+
+    count = build_pyramid(args[0], options.max_zoom, options.min_zoom,
+        processes=options.processes, tile_size=options.tile_size, dedup=options.dedup)
+    logging.info("Built %d tiles" % count)
+
+if __name__ == "__main__":
+    _main()
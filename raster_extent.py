@@ -1,14 +1,26 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from osgeo import gdal, ogr, osr
+from osgeo import gdal, osr
 import sys
 import logging
 from optparse import OptionParser
 import os
 import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from tilenames import tileEdges
 
 gdal.UseExceptions()
 
+## Rasters handed to each worker process at a time
+CHUNK_SIZE = 16
+WGS84 = 4326
+WEB_MERCATOR = 3857
+## Points interpolated along each edge before reprojecting, as gdalwarp does,
+## so edges that curve in the target CRS stay inside the footprint's bbox
+DENSIFY_POINTS = 21
+
 def GetExtent(gt,cols,rows):
     ''' Return list of corner coordinates from a geotransform
 
@@ -34,12 +46,11 @@ def GetExtent(gt,cols,rows):
     return ext
 
 
-def get_raster_extent(source_file, options):
+def get_raster_extent(source_file, options=None):
     try:
         src_ds = gdal.Open(source_file)
-    except RuntimeError, e:
-        print 'Unable to open ' + source_file
-        print e
+    except RuntimeError as e:
+        logging.error('Unable to open %s: %s' % (source_file, e))
         return None
 
     gt = src_ds.GetGeoTransform()
@@ -54,35 +65,285 @@ def get_raster_extent(source_file, options):
 
     return extent, properties
 
+
+_transforms = {}
+
+def _transform_to(wkt, epsg):
+    """Cached transformation from the CRS in wkt to epsg, in x/y (lon/lat) order."""
+    key = (wkt, epsg)
+    if key not in _transforms:
+        src = osr.SpatialReference()
+        src.ImportFromWkt(wkt)
+        dst = osr.SpatialReference()
+        dst.ImportFromEPSG(epsg)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            ## GDAL 3 otherwise uses lat/lon order for EPSG:4326
+            src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        _transforms[key] = osr.CoordinateTransformation(src, dst)
+    return _transforms[key]
+
+
+def _densify(extent, points):
+    """The ring of extent's corners with points interpolated along each edge."""
+    ring = []
+    for (x0, y0), (x1, y1) in zip(extent, list(extent[1:]) + list(extent[:1])):
+        for i in range(points + 1):
+            t = i / float(points + 1)
+            ring.append([x0 + (x1 - x0) * t, y0 + (y1 - y0) * t])
+    return ring
+
+
+def reproject_extent(extent, wkt, epsg=WGS84, densify=DENSIFY_POINTS):
+    """
+    Transform the corners from GetExtent, in the CRS described by wkt, to
+    epsg, with densify points along each edge. Corner i of the result is at
+    index i * (densify + 1). Returns None if the raster has no CRS or cannot
+    be transformed.
+    """
+    if not wkt:
+        return None
+    try:
+        ct = _transform_to(wkt, epsg)
+        return [list(ct.TransformPoint(x, y)[:2]) for x, y in _densify(extent, densify)]
+    except (RuntimeError, TypeError) as e:
+        logging.warning('Unable to reproject extent from %s: %s' % (wkt[:40], e))
+        return None
+
+
+def _bbox(extent):
+    xs = [x for x, _ in extent]
+    ys = [y for _, y in extent]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+class FootprintIndex(object):
+    """
+    SQLite file with an R-tree of raster footprint bounding boxes in
+    longitude/latitude, for looking up the rasters under a bbox or tile
+    without reading every footprint.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rasters ("
+            "id INTEGER PRIMARY KEY, filename TEXT UNIQUE, footprint TEXT, properties TEXT)")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS rasters_rtree "
+            "USING rtree(id, minx, maxx, miny, maxy)")
+        self._conn.commit()
+
+    def add(self, filename, lonlat_extent, properties):
+        w, s, e, n = _bbox(lonlat_extent)
+        ## replace any earlier footprint of this raster, in both tables
+        self._conn.execute("DELETE FROM rasters_rtree WHERE id IN "
+            "(SELECT id FROM rasters WHERE filename = ?)", (filename,))
+        self._conn.execute("DELETE FROM rasters WHERE filename = ?", (filename,))
+        raster_id = self._conn.execute("INSERT INTO rasters (filename, footprint, properties) "
+            "VALUES (?, ?, ?)", (filename, json.dumps(lonlat_extent), json.dumps(properties))).lastrowid
+        self._conn.execute("INSERT INTO rasters_rtree VALUES (?, ?, ?, ?, ?)",
+            (raster_id, w, e, s, n))
+
+    def query(self, w, s, e, n):
+        """Filenames of rasters whose footprint bbox intersects w,s,e,n."""
+        rows = self._conn.execute("SELECT r.filename FROM rasters_rtree t "
+            "JOIN rasters r ON r.id = t.id "
+            "WHERE t.minx <= ? AND t.maxx >= ? AND t.miny <= ? AND t.maxy >= ? "
+            "ORDER BY r.filename", (e, w, n, s))
+        return [row[0] for row in rows]
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def tile_bbox(tile):
+    """w,s,e,n in longitude/latitude of a z/x/y tile string."""
+    z, x, y = [int(v) for v in tile.split('/')]
+    s, w, n, e = tileEdges(x, y, z)
+    return w, s, e, n
+
+
+class FootprintCache(object):
+    """
+    SQLite cache of raster footprints keyed by path, mtime and size, so
+    rasters that have not changed since the last run are not reopened.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS footprints ("
+            "path TEXT PRIMARY KEY, mtime REAL, size INTEGER, extent TEXT, properties TEXT)")
+        self._conn.commit()
+
+    def get(self, path, mtime, size):
+        row = self._conn.execute("SELECT extent, properties FROM footprints "
+            "WHERE path = ? AND mtime = ? AND size = ?", (path, mtime, size)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, path, mtime, size, extent, properties):
+        self._conn.execute("INSERT OR REPLACE INTO footprints VALUES (?, ?, ?, ?, ?)",
+            (path, mtime, size, json.dumps(extent), json.dumps(properties)))
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def _scan(path):
+    """Process pool worker: footprint of one raster, or None if unreadable."""
+    return path, get_raster_extent(path)
+
+
+def iter_footprints(paths, processes=None, cache=None):
+    """
+    Yield (path, extent, properties) for each readable raster in paths, in
+    order. Cached footprints are used as-is; the rest are opened in a
+    process pool and added to the cache.
+    """
+    stats = {}
+    pending = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            logging.error(path + " not found")
+            continue
+        stats[path] = (st.st_mtime, st.st_size)
+        pending.append(path)
+
+    hits = {}
+    if cache is not None:
+        for path in pending:
+            hit = cache.get(path, *stats[path])
+            if hit is not None:
+                hits[path] = hit
+    misses = [path for path in pending if path not in hits]
+    logging.info("%d rasters cached, %d to scan" % (len(hits), len(misses)))
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        ## map() yields in submission order, so output follows the input order
+        scanned = pool.map(_scan, misses, chunksize=CHUNK_SIZE)
+        for count, path in enumerate(pending):
+            if path in hits:
+                yield (path,) + tuple(hits[path])
+                continue
+            _, footprint = next(scanned)
+            if footprint is None:
+                continue
+            extent, properties = footprint
+            if cache is not None:
+                cache.put(path, stats[path][0], stats[path][1], extent, properties)
+                if count % 1000 == 999:
+                    cache.commit()
+            yield path, extent, properties
+
+
+def footprint_features(extent, properties, centroids=False):
+    ## the 4 corners, or a ring densified by reproject_extent
+    ul, lr = extent[0], extent[len(extent) // 2]
+    geometry = {"type":"LineString", "coordinates" : list(extent) + [ul]}
+    yield {"type":"Feature", "geometry":geometry, "properties":properties,
+        "bbox":_bbox(extent)}
+    if centroids:
+        centroid_point = ((ul[0]+lr[0])/2.0, (ul[1]+lr[1])/2.0)
+        centroid_geometry = {"type":"Point", "coordinates":centroid_point}
+        yield {"type":"Feature", "geometry":centroid_geometry,
+            "properties":properties}
+
+
+def _read_file_list(path):
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        return [line.strip() for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
 if __name__=='__main__':
     usage = "usage: %prog foo.tiff bar.tiff"
     parser = OptionParser(usage=usage,
-        description="Generate a GeoJSON file representing the extent of a set of rasters")
+        description="Generate newline-delimited GeoJSON representing the extent of a set of rasters")
     parser.add_option("-d", "--debug", action="store_true", dest="debug")
     parser.add_option("-q", "--quiet", action="store_true", dest="quiet")
     parser.add_option("-c", "--centroids", action="store_true", dest="centroids",
      help="Add centroid markers")
+    parser.add_option("-l", "--file-list", action="store", dest="file_list",
+     help="Read raster paths, one per line, from this file ('-' for stdin)")
+    parser.add_option("-p", "--processes", action="store", type="int", dest="processes",
+     help="Number of worker processes (default: one per CPU)")
+    parser.add_option("--cache", action="store", dest="cache",
+     help="SQLite footprint cache; rasters with unchanged mtime and size are not reopened")
+    parser.add_option("-t", "--t-srs", action="store", type="int", dest="t_srs", default=WGS84,
+     help="EPSG code to reproject footprints to: 4326 (default) or 3857. 0 keeps each raster's own CRS")
+    parser.add_option("-i", "--index", action="store", dest="index",
+     help="SQLite R-tree index of footprints to update, or to query with --bbox/--tile")
+    parser.add_option("--bbox", action="store", dest="query_bbox",
+     help="Print the indexed rasters intersecting W,S,E,N (longitude/latitude)")
+    parser.add_option("--tile", action="store", dest="query_tile",
+     help="Print the indexed rasters intersecting the z/x/y tile")
+    parser.add_option("--feature-collection", action="store_true", dest="feature_collection",
+     help="Write a single FeatureCollection instead of one feature per line")
     (options, args) = parser.parse_args()
-    
-    logging.basicConfig(level=logging.DEBUG if options.debug else 
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else
         (logging.ERROR if options.quiet else logging.INFO))
- 
-    features = []
-    for path in args:
-        if not os.path.exists(path):
-            print path + " not found"
-            continue
-        extent, properties = get_raster_extent(path, options)
-        ul, ll, lr, ur = extent
-        geometry = {"type":"LineString", "coordinates" : [ul, ll, lr, ur, ul]}
-        feature = {"type":"Feature", "geometry":geometry, "properties":properties}
-        features.append(feature)
-        if options.centroids:
-            centroid_point = ((ul[0]+lr[0])/2.0, (ul[1]+lr[1])/2.0)
-            centroid_geometry = {"type":"Point", "coordinates":centroid_point}
-            centroid_feature = {"type":"Feature", "geometry":centroid_geometry, 
-                "properties":properties}
-            features.append(centroid_feature)
-    feature_collection = {"type":"FeatureCollection", "features":features}
-    print json.dumps(feature_collection, sort_keys=True,
-        indent=4, separators=(',', ': '))
+
+    if options.query_bbox or options.query_tile:
+        if not options.index:
+            parser.error("--bbox and --tile query an --index")
+        if options.query_tile:
+            bbox = tile_bbox(options.query_tile)
+        else:
+            bbox = [float(v) for v in options.query_bbox.split(',')]
+        index = FootprintIndex(options.index)
+        for filename in index.query(*bbox):
+            print(filename)
+        index.close()
+        sys.exit(0)
+
+    paths = list(args)
+    if options.file_list:
+        paths.extend(_read_file_list(options.file_list))
+
+    cache = FootprintCache(options.cache) if options.cache else None
+    index = FootprintIndex(options.index) if options.index else None
+    out = sys.stdout
+    first = True
+    if options.feature_collection:
+        out.write('{"type": "FeatureCollection", "features": [\n')
+    try:
+        for count, (path, extent, properties) in enumerate(
+                iter_footprints(paths, options.processes, cache)):
+            lonlat = reproject_extent(extent, properties['projection'])
+            if lonlat is None:
+                logging.warning('%s has no usable CRS; writing native coordinates' % path)
+            else:
+                if index is not None:
+                    index.add(path, lonlat, properties)
+                    if count % 1000 == 999:
+                        index.commit()
+                if options.t_srs == WGS84:
+                    extent = lonlat
+                elif options.t_srs:
+                    extent = reproject_extent(extent, properties['projection'], options.t_srs) or extent
+            for feature in footprint_features(extent, properties, options.centroids):
+                if options.feature_collection and not first:
+                    out.write(',\n')
+                out.write(json.dumps(feature, sort_keys=True))
+                if not options.feature_collection:
+                    out.write('\n')
+                first = False
+    finally:
+        if cache is not None:
+            cache.close()
+        if index is not None:
+            index.close()
+    if options.feature_collection:
+        out.write('\n]}\n')
@@ -3,13 +3,26 @@
 import logging
 from optparse import OptionParser
 import os
+import sys
+import queue
+import signal
+import sqlite3
+import threading
+import hashlib
+import json
+import zlib
+import multiprocessing
+from collections import Counter
 from urllib.parse import urlparse
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor, wait
 import boto3 
-from botocore.exceptions import BotoCoreError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
-from time import sleep
+import instrumentation
+
+import time
 from datetime import datetime
 import pickle 
 
@@ -24,11 +37,525 @@ AWS_SYSTEM_METADATA_KEYS = [
     "ContentType",
 ]
 
-def _exit_gracefully(current_page):
+## Counters and stage timings, reported by --stats-interval/--prometheus-textfile
+STATS = instrumentation.Stats()
+
+## Keys queued ahead of the workers, per worker thread
+QUEUE_DEPTH = 100
+## Seconds between checkpoint writes
+CHECKPOINT_INTERVAL = 30
+## Keys per pseudo-page when retrying keys from a failed-key log
+RETRY_PAGE_SIZE = 1000
+## Levels of sub-prefixes (e.g. z/ then z/x/ in a tile tree) split between shards
+SHARD_DEPTH = 2
+DEFAULT_SHARD_CHECKPOINT = "s3_meta_resume_shard{shard}.pkl"
+
+_client = None
+_client_lock = threading.Lock()
+
+def _get_client(max_pool_connections=None):
+    """
+    Return the process-wide S3 client, creating it on first use. boto3
+    clients are thread-safe, so every worker shares one client and one
+    connection pool instead of rebuilding them per key.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = Config(max_pool_connections=max_pool_connections) if max_pool_connections else None
+                _client = boto3.client('s3', config=config)
+    return _client
+
+## Records buffered in memory, then written to the cache in one short transaction
+CACHE_COMMIT_INTERVAL = 1000
+## Seconds to wait for another shard process holding the cache's write lock
+CACHE_BUSY_TIMEOUT = 60
+
+class MetadataCache(object):
+    """
+    Local SQLite record of the metadata applied to each key, with the
+    object's ETag and size afterwards. A key whose listed ETag and size
+    still match a record for the same requested metadata needs no HEAD
+    or copy on a re-run.
+
+    Records are buffered and written in one transaction on a separate
+    connection, outside the lock lookups take, so shard processes sharing
+    the file only hold its write lock briefly and never across a copy.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._conn = sqlite3.connect(path, timeout=CACHE_BUSY_TIMEOUT, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS applied ("
+            "bucket TEXT, key TEXT, etag TEXT, size INTEGER, metadata TEXT, "
+            "PRIMARY KEY (bucket, key))")
+        self._conn.commit()
+        self._writer = sqlite3.connect(path, timeout=CACHE_BUSY_TIMEOUT, check_same_thread=False)
+
+    def matches(self, bucket, key, etag, size, metadata_hash):
+        with self._lock:
+            if self._conn is None:
+                return False
+            row = self._conn.execute("SELECT etag, size, metadata FROM applied "
+                "WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+        return row is not None and tuple(row) == (etag, size, metadata_hash)
+
+    def record(self, bucket, key, etag, size, metadata_hash):
+        with self._lock:
+            ## workers may still be finishing after an interrupt closed the cache
+            if self._conn is None:
+                return
+            self._pending.append((bucket, key, etag, size, metadata_hash))
+            if len(self._pending) < CACHE_COMMIT_INTERVAL:
+                return
+            rows, self._pending = self._pending, []
+        self._write(rows)
+
+    def _write(self, rows):
+        with self._write_lock:
+            try:
+                with self._writer:
+                    self._writer.executemany("INSERT OR REPLACE INTO applied VALUES (?, ?, ?, ?, ?)",
+                        rows)
+            except sqlite3.Error as e:
+                ## the copies succeeded; these keys are just checked again next run
+                logging.warning(f"Unable to record {len(rows)} keys in the metadata cache: {e}")
+
+    def close(self):
+        with self._lock:
+            rows, self._pending = self._pending, []
+            self._conn.close()
+            self._conn = None
+        if rows:
+            self._write(rows)
+        with self._write_lock:
+            self._writer.close()
+
+
+def _metadata_hash(new_metadata):
+    sys_meta, user_meta = _prep_metadata(new_metadata)
+    encoded = json.dumps([sys_meta, user_meta], sort_keys=True)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
+class _PageTracker(object):
+    """
+    Tracks which listing pages have had every key processed. Keys finish
+    out of order, so the resume point is the last page for which it and all
+    earlier pages are complete.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._remaining = {}
+        self._next = 0
+        self.last_done_page = None
+
+    def add(self, index, page, count):
+        with self._lock:
+            self._remaining[index] = [count, {
+                "Prefix": page.get("Prefix"),
+                "NextContinuationToken": page.get("NextContinuationToken"),
+            }]
+            self._advance()
+
+    def done(self, index):
+        with self._lock:
+            self._remaining[index][0] -= 1
+            self._advance()
+
+    def _advance(self):
+        while self._next in self._remaining and self._remaining[self._next][0] == 0:
+            self.last_done_page = self._remaining.pop(self._next)[1]
+            self._next += 1
+
+
+def _default_checkpoint_path():
     date = '{:%Y-%m-%d-%H-%M-%S}'.format(datetime.now())
-    if current_page is not None:
-        with open(f"s3_meta_resume_{date}.pkl", 'wb') as f:
-            pickle.dump(current_page, f)
+    return f"s3_meta_resume_{date}.pkl"
+
+def _save_checkpoint(path, bucket, current_page):
+    """
+    Atomically write the resume point: a temp file renamed over path, so a
+    crash mid-write never leaves a corrupt checkpoint. The bucket is saved
+    with it so a resume against a different listing can be refused.
+    """
+    if path is None or current_page is None:
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(dict(current_page, Bucket=bucket), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _check_resume_point(resume_point, bucket, prefix):
+    """
+    Raise ValueError unless resume_point was saved while listing prefix (or
+    a sub-prefix of it) in bucket. Checkpoints from before the bucket was
+    recorded are accepted as they are.
+    """
+    saved_bucket = resume_point.get("Bucket", bucket)
+    saved_prefix = resume_point.get("Prefix") or ""
+    if saved_bucket != bucket or not saved_prefix.startswith(prefix):
+        raise ValueError(f"checkpoint is for s3://{saved_bucket}/{saved_prefix}, "
+            f"not s3://{bucket}/{prefix}")
+
+
+class FailedKeyLog(object):
+    """
+    Append-only log of keys whose update failed, one s3://bucket/key per
+    line, flushed as written. Pass it back with --retry-failed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def write(self, bucket, key):
+        with self._lock:
+            self._file.write(f"s3://{bucket}/{key}\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def _failed_key_pages(path):
+    """
+    Read a failed-key log into {bucket: [page, ...]} with pages shaped like
+    list_objects_v2 responses.
+    """
+    keys = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            ## not urlparse: keys may contain '?' or '#'
+            bucket, _, key = line[len("s3://"):].partition("/")
+            keys.setdefault(bucket, []).append(key)
+    pages = {}
+    for bucket, bucket_keys in keys.items():
+        ## a key may have failed more than once
+        bucket_keys = list(dict.fromkeys(bucket_keys))
+        pages[bucket] = [{'Contents': [{'Key': key} for key in bucket_keys[i:i + RETRY_PAGE_SIZE]]}
+            for i in range(0, len(bucket_keys), RETRY_PAGE_SIZE)]
+    return pages
+
+
+def _list_keys(bucket_pages, work, tracker, workers, stop):
+    """
+    Producer: list pages and feed their keys into the bounded work queue,
+    running ahead of the workers until the queue is full.
+    """
+    try:
+        pages = iter(bucket_pages)
+        index = 0
+        while True:
+            with STATS.timer("list"):
+                page = next(pages, None)
+            if page is None:
+                break
+            STATS.incr("pages")
+            contents = page.get('Contents', [])
+            tracker.add(index, page, len(contents))
+            ## time spent blocked on a full queue means the workers are the bottleneck
+            with STATS.timer("queue_wait"):
+                for obj in contents:
+                    if stop.is_set():
+                        return
+                    work.put((index, obj))
+            index += 1
+    finally:
+        for _ in range(workers):
+            work.put(None)
+
+
+def _process_keys(s3, bucket, new_metadata, work, tracker, progress, progress_lock,
+        counts, cache=None, preserve=True, failed_log=None):
+    metadata_hash = _metadata_hash(new_metadata)
+    while True:
+        item = work.get()
+        if item is None:
+            return
+        index, obj = item
+        key, etag, size = obj['Key'], obj.get('ETag'), obj.get('Size')
+        outcome = "failed"
+        try:
+            if cache is not None and cache.matches(bucket, key, etag, size, metadata_hash):
+                logging.debug(f"metadata already applied ({key})")
+                outcome = "cached"
+            else:
+                new_etag = replace_metadata(bucket, key, new_metadata, s3=s3,
+                    etag=etag, preserve=preserve)
+                if new_etag is not None:
+                    outcome = "processed"
+                    if cache is not None:
+                        cache.record(bucket, key, new_etag, size, metadata_hash)
+        except Exception:
+            logging.exception(f"Failed to update s3://{bucket}/{key}")
+            outcome = "failed"
+        finally:
+            ## always release the key, or the lister blocks waiting on its page
+            if outcome == "failed" and failed_log is not None:
+                failed_log.write(bucket, key)
+            tracker.done(index)
+        STATS.incr("objects_" + outcome)
+        with progress_lock:
+            counts[outcome] += 1
+            progress.update(1)
+
+
+def update_metadata(s3, bucket, bucket_pages, new_metadata, threads, cache=None, preserve=True,
+        checkpoint=None, failed_log=None, progress=None):
+    """
+    Apply new_metadata to every key in bucket_pages (list_objects_v2
+    responses), listing ahead of a pool of worker threads. The resume point
+    is written to checkpoint every CHECKPOINT_INTERVAL seconds and when
+    interrupted. progress is anything with update(n) and close(), a tqdm bar
+    by default. Returns a Counter of outcomes.
+    """
+    work = queue.Queue(maxsize=threads * QUEUE_DEPTH)
+    tracker = _PageTracker()
+    stop = threading.Event()
+    if progress is None:
+        progress = tqdm(unit='objects')
+    progress_lock = threading.Lock()
+    counts = Counter()
+    pool = ThreadPoolExecutor(max_workers=threads + 1)
+    try: 
+        logging.info("Processing files...")
+        lister = pool.submit(_list_keys, bucket_pages, work, tracker, threads, stop)
+        _fs = [pool.submit(_process_keys, s3, bucket, new_metadata, work, tracker,
+            progress, progress_lock, counts, cache, preserve, failed_log) for _ in range(threads)]
+        ## wait with a timeout so KeyboardInterrupt is delivered promptly
+        last_checkpoint = time.monotonic()
+        while wait(_fs, timeout=1).not_done:
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                _save_checkpoint(checkpoint, bucket, tracker.last_done_page)
+                last_checkpoint = time.monotonic()
+        lister.result()
+        progress.close()
+        logging.info("%d objects updated or already current, %d skipped from cache, %d failed" % (
+            counts["processed"], counts["cached"], counts["failed"]))
+        return counts
+
+    except KeyboardInterrupt as e:
+        stop.set()
+        _drain(work)
+        _save_checkpoint(checkpoint, bucket, tracker.last_done_page)
+        if checkpoint is not None:
+            logging.info(f"Saved resume point to {checkpoint}")
+        raise e
+    finally:
+        pool.shutdown(wait=False)
+
+
+def _drain(work):
+    """Discard queued keys so workers and the lister wind down quickly."""
+    while True:
+        try:
+            item = work.get_nowait()
+        except queue.Empty:
+            return
+        if item is None:
+            work.put(None)
+            return
+
+
+def shard_prefixes(s3, bucket, prefix, depth=SHARD_DEPTH):
+    """
+    Split prefix into the sub-prefixes depth levels below it, e.g. the z/x/
+    directories of a tile tree. Returns the sorted sub-prefixes and the
+    objects found directly above that depth, which belong to no sub-prefix.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    prefixes = [prefix]
+    loose = []
+    for _ in range(depth):
+        next_prefixes = []
+        for p in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=p, Delimiter='/'):
+                next_prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+                loose.extend(page.get('Contents', []))
+        prefixes = next_prefixes
+    return sorted(prefixes), loose
+
+
+def _shard_of(prefix, shard_count):
+    ## crc32 is stable across processes and machines, unlike hash()
+    return zlib.crc32(prefix.encode('utf-8')) % shard_count
+
+
+def _shard_pages(s3, bucket, prefixes, loose, resume_point=None):
+    """
+    Yield list_objects_v2 pages for each prefix in order, starting from the
+    checkpointed page if resuming. Loose objects come first as one page with
+    an empty Prefix.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    units = ([""] if loose else []) + prefixes
+    start, token = 0, None
+    if resume_point is not None and resume_point.get("Prefix") in units:
+        start = units.index(resume_point["Prefix"])
+        token = resume_point.get("NextContinuationToken")
+        if token is None:
+            ## the checkpointed prefix was finished
+            start += 1
+    for i, unit in enumerate(units[start:]):
+        if unit == "":
+            yield {'Prefix': "", 'Contents': loose}
+            continue
+        pag_opts = {"StartingToken": token} if i == 0 and token else {}
+        for page in paginator.paginate(Bucket=bucket, Prefix=unit, PaginationConfig=pag_opts):
+            yield page
+
+
+class _SharedProgress(object):
+    """Progress adapter that adds to a counter shared with the parent process."""
+    def __init__(self, counter):
+        self.counter = counter
+
+    def update(self, n=1):
+        with self.counter.get_lock():
+            self.counter.value += n
+
+    def close(self):
+        pass
+
+
+def run_shard(bucket, prefix, shard, shard_count, new_metadata, threads, cache_path=None,
+        preserve=True, checkpoint_template=DEFAULT_SHARD_CHECKPOINT, failed_log_path=None,
+        progress=None, stats_interval=None, stats_file=None, prometheus_textfile=None):
+    """
+    Update the keys under prefix that belong to shard (of shard_count).
+    Sub-prefixes are assigned to shards by hash, so every shard enumerates
+    the same split independently. Each shard checkpoints to its own file and
+    resumes from it if present, and reports its stats labelled by shard.
+    """
+    s3 = _get_client(max_pool_connections=threads + 1)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    prefixes, loose = shard_prefixes(s3, bucket, prefix)
+    mine = [p for p in prefixes if _shard_of(p, shard_count) == shard]
+    ## objects above the split depth all go to the first shard
+    loose = loose if shard == 0 else []
+    logging.info(f"shard {shard}/{shard_count}: {len(mine)} of {len(prefixes)} prefixes")
+
+    shard_name = f"{shard}-of-{shard_count}"
+    ## a template without {shard} still gets one checkpoint per shard
+    checkpoint = _shard_path(checkpoint_template, shard_name, shard_count)
+    resume_point = None
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'rb') as f:
+            resume_point = pickle.load(f)
+        ## the loose objects' page is saved with an empty Prefix
+        _check_resume_point(resume_point, bucket, prefix if resume_point.get("Prefix") else "")
+        logging.info(f"shard {shard}/{shard_count}: resuming from {checkpoint}")
+
+    cache = MetadataCache(cache_path) if cache_path else None
+    failed_log = FailedKeyLog(failed_log_path) if failed_log_path else None
+    reporter = instrumentation.StatsReporter(STATS, "set_s3_metadata", stats_interval,
+        _shard_path(stats_file, shard_name, shard_count),
+        _shard_path(prometheus_textfile, shard_name, shard_count), labels={"shard": shard_name})
+    try:
+        counts = update_metadata(s3, bucket, _shard_pages(s3, bucket, mine, loose, resume_point),
+            new_metadata, threads, cache=cache, preserve=preserve, checkpoint=checkpoint,
+            failed_log=failed_log, progress=progress)
+    finally:
+        reporter.stop()
+        if cache is not None:
+            cache.close()
+        if failed_log is not None:
+            failed_log.close()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return counts
+
+
+def _shard_path(path, shard_name, shard_count):
+    """
+    Per-shard checkpoint or stats output path: {shard} in path is replaced,
+    otherwise the shard is inserted before the extension so node_exporter
+    still matches *.prom.
+    """
+    if path is None:
+        return None
+    if "{shard}" in path:
+        return path.format(shard=shard_name)
+    if shard_count == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{shard_name}{ext}"
+
+
+def _shard_process(results, counter, log_level, args, kwargs):
+    logging.basicConfig(level=log_level)
+    ## the parent forwards Ctrl-C as SIGTERM, so each shard checkpoints once
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        counts = run_shard(*args, progress=_SharedProgress(counter), **kwargs)
+        results.put((args[2], dict(counts)))
+    except KeyboardInterrupt:
+        results.put((args[2], None))
+
+
+def run_shards_locally(bucket, prefix, shards, shard_count, new_metadata, threads, **kwargs):
+    """
+    Run each shard index in shards in its own process, with one combined
+    progress bar. Returns the summed Counter of outcomes.
+    """
+    ## spawn, not fork: boto3 clients are not safe to share across a fork
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    counter = ctx.Value('q', 0)
+    processes = [ctx.Process(target=_shard_process, args=(results, counter,
+        logging.getLogger().getEffectiveLevel(),
+        (bucket, prefix, shard, shard_count, new_metadata, threads), kwargs))
+        for shard in shards]
+    for process in processes:
+        process.start()
+
+    progress = tqdm(unit='objects')
+    totals = Counter()
+    finished = 0
+    try:
+        while finished < len(processes):
+            try:
+                shard, counts = results.get(timeout=1)
+                finished += 1
+                if counts is None:
+                    logging.error(f"shard {shard}/{shard_count} was interrupted")
+                else:
+                    totals.update(counts)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    logging.error("shard processes exited without reporting")
+                    break
+            progress.update(counter.value - progress.n)
+        progress.close()
+    except KeyboardInterrupt as e:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        raise e
+    for process in processes:
+        process.join()
+    logging.info("%d objects updated or already current, %d skipped from cache, %d failed" % (
+        totals["processed"], totals["cached"], totals["failed"]))
+    return totals
+
+
+def _terminate(signum, frame):
+    ## SIGTERM (e.g. spot instance reclaim, systemd stop) is handled like Ctrl-C
+    raise KeyboardInterrupt()
+
 
 def _get_existing_system_metadata(existing_object):
     """
@@ -43,45 +570,88 @@ def _get_existing_system_metadata(existing_object):
 def _prep_metadata(metadata):
     """
     Separate user and system defined metadata keys from metadata dict
-    passed from user input
+    passed from user input. System keys match without hyphens or case
+    (Cache-Control is CacheControl); user keys are only lowercased, as S3
+    stores them, so hyphens are kept.
     """
     sys_meta = {}
-    user_meta = {_k.replace("-", "").strip().lower() : _v for _k, _v in metadata.items()}
-    for syskey in AWS_SYSTEM_METADATA_KEYS: 
-        if syskey.lower() in user_meta:
-            sys_meta[syskey] = user_meta[syskey.lower()]
-            del user_meta[syskey.lower()]
+    user_meta = {}
+    system_keys = {syskey.lower(): syskey for syskey in AWS_SYSTEM_METADATA_KEYS}
+    for _k, _v in metadata.items():
+        _k = _k.strip()
+        syskey = system_keys.get(_k.replace("-", "").lower())
+        if syskey:
+            sys_meta[syskey] = _v
+        else:
+            user_meta[_k.lower()] = _v
 
     return (sys_meta,user_meta)
 
-def replace_metadata(bucket, key, new_metadata):
-    s3 = boto3.client('s3')
-    try:
-        ## Get existing system and user defined metadata
-        existing = s3.head_object(
-            Key=key, Bucket=bucket
-        )
-        existing_system_metadata = _get_existing_system_metadata(existing)
-        existing_user_metadata = existing['Metadata']
-        existing_etag = existing["ETag"]
+def _metadata_matches(existing_system_metadata, existing_user_metadata, new_sys_meta, new_user_meta):
+    return all(existing_system_metadata.get(k) == v for k, v in new_sys_meta.items()) and \
+        all(existing_user_metadata.get(k) == v for k, v in new_user_meta.items())
 
+def replace_metadata(bucket, key, new_metadata, s3=None, etag=None, preserve=True):
+    """
+    Apply new_metadata to an object by copying it onto itself.
+
+    With preserve (the default) the object is HEADed first so existing
+    system and user metadata are kept, and the copy is skipped if the
+    requested values are already set. Without preserve no HEAD is made:
+    the object's metadata is replaced with exactly new_metadata, guarded by
+    etag from the listing.
+
+    Returns the object's ETag afterwards, or None if the update failed.
+    """
+    if s3 is None:
+        s3 = _get_client()
+    try:
         ## get updates to user and system defined metadata
         new_sys_meta, new_user_meta = _prep_metadata(new_metadata)
 
-        existing_user_metadata.update(new_user_meta)
-        existing_system_metadata.update(new_sys_meta)
-
-        s3.copy_object(
-            Key=key, Bucket=bucket, 
-            CopySource={"Bucket": bucket, "Key": key}, 
-            Metadata=new_metadata, 
-            MetadataDirective='REPLACE', 
-            CopySourceIfMatch=existing_etag, 
-            **existing_system_metadata
-        )
+        if preserve:
+            ## Get existing system and user defined metadata
+            with STATS.timer("head"):
+                existing = s3.head_object(
+                    Key=key, Bucket=bucket
+                )
+            existing_system_metadata = _get_existing_system_metadata(existing)
+            existing_user_metadata = existing['Metadata']
+            existing_etag = existing["ETag"]
+
+            if _metadata_matches(existing_system_metadata, existing_user_metadata,
+                    new_sys_meta, new_user_meta):
+                logging.debug(f"metadata already set ({key})")
+                STATS.incr("copy_skipped")
+                return existing_etag
+
+            existing_user_metadata.update(new_user_meta)
+            existing_system_metadata.update(new_sys_meta)
+        else:
+            existing_system_metadata = dict(new_sys_meta)
+            existing_user_metadata = dict(new_user_meta)
+            existing_etag = etag
+
+        copy_args = dict(existing_system_metadata)
+        if existing_etag:
+            copy_args["CopySourceIfMatch"] = existing_etag
+        with STATS.timer("copy"):
+            result = s3.copy_object(
+                Key=key, Bucket=bucket, 
+                CopySource={"Bucket": bucket, "Key": key}, 
+                Metadata=existing_user_metadata, 
+                MetadataDirective='REPLACE', 
+                **copy_args
+            )
         logging.debug(f"copy successful ({key})")
-    except BotoCoreError as e:
+        return result["CopyObjectResult"]["ETag"]
+    except (BotoCoreError, ClientError) as e:
         logging.error(f"Error copying key: {key}: {e}")
+        if isinstance(e, ClientError):
+            STATS.incr("error_" + e.response.get("Error", {}).get("Code", "Unknown"))
+        else:
+            STATS.incr("error_" + type(e).__name__)
+        return None
     
 
 def _main():
@@ -96,14 +666,45 @@ def _main():
                       help="<KEY>=<VALUE>. AWS S3 System defined metadata keys should contain hyphens.")
     parser.add_option("-r", "--resume", action='store', dest='resume', 
                        help="Resume from existing saved state file (e.g. s3_meta_resume_*.pkl)")
+    parser.add_option("--checkpoint", action='store', dest='checkpoint', default=None,
+                       help="File to periodically save the resume point to (default s3_meta_resume_<date>.pkl)")
+    parser.add_option("--failed-log", action='store', dest='failed_log', default=None,
+                       help="Append the s3:// URL of every key that fails to update to this file")
+    parser.add_option("--retry-failed", action='store', dest='retry_failed', default=None,
+                       help="Instead of listing, retry the keys in a --failed-log file")
+    parser.add_option("--shard", action='store', dest='shard', default=None,
+                       help="i/N: only update shard i (0-based) of N disjoint key ranges under the prefix. "
+                       "Each shard checkpoints to its own file ({shard} in --checkpoint is replaced, "
+                       "otherwise the shard is appended before the extension) "
+                       "and resumes from it automatically")
+    parser.add_option("-p", "--processes", action='store', dest='processes', type=int, default=None,
+                       help="Split the prefix (or this --shard) into this many shards and run each "
+                       "in a local process")
     parser.add_option("-t", "--threads", action='store', dest="threads", type=int, default=None,
                       help="Number of threads to use when setting metadata (default =  min(32, os.cpu_count() + 4))")
+    parser.add_option("-c", "--cache", action='store', dest="cache", default=None,
+                      help="SQLite file recording applied metadata; keys whose listed ETag and size match "
+                      "a previous run with the same --set values are skipped without any request")
+    parser.add_option("--no-preserve", action='store_false', dest="preserve", default=True,
+                      help="Don't HEAD each object to keep its existing metadata; replace it with exactly "
+                      "the --set values")
+    parser.add_option("--stats-interval", action='store', dest='stats_interval', type=float, default=None,
+                      help="Log a JSON line of counters, rates and list/head/copy latency percentiles "
+                      "every this many seconds")
+    parser.add_option("--stats-file", action='store', dest='stats_file', default=None,
+                      help="Append the JSON stats lines to this file instead of the log "
+                      "(per shard; may contain {shard})")
+    parser.add_option("--prometheus-textfile", action='store', dest='prometheus_textfile', default=None,
+                      help="Rewrite this file with Prometheus metrics for node_exporter's textfile "
+                      "collector (per shard; may contain {shard})")
     (options, args) = parser.parse_args()
  
     logging.basicConfig(level=logging.DEBUG if options.debug else
     (logging.ERROR if options.quiet else logging.INFO))
 
-    s3 = boto3.client('s3')
+    threads = options.threads or min(32, (os.cpu_count() or 1) + 4)
+    ## one connection per worker, plus one for the lister
+    s3 = _get_client(max_pool_connections=threads + 1)
 
     values_to_set = {}
     for o in options.set:
@@ -115,39 +716,106 @@ def _main():
         logging.debug("will set '%s'='%s'" % (split_option[0], split_option[1]))
 
 
-    for arg in args:
-        url_parts = urlparse(arg)
-        bucket_name = url_parts.netloc
+    sharded = (options.shard or options.processes) and not options.retry_failed
+    shard, shard_count = 0, 1
+    if options.shard:
+        try:
+            shard, shard_count = [int(v) for v in options.shard.split("/")]
+        except ValueError:
+            shard_count = 0
+        if not 0 <= shard < shard_count:
+            logging.error("--shard must be i/N with 0 <= i < N: '%s'" % options.shard)
+            sys.exit(-1)
 
-        s3_prefix = url_parts.path.strip("/")
-        bucket_paginator = s3.get_paginator('list_objects_v2')
-        
-        # resume from file if given
-        pag_opts = {"StartingToken" : pickle.load(open(options.resume, 'rb'))['NextContinuationToken']} if options.resume else {}
+    signal.signal(signal.SIGTERM, _terminate)
 
-        bucket_pages = bucket_paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix, PaginationConfig=pag_opts)
+    ## shards open the cache and failed-key log, and report, from their own processes
+    cache = failed_log = reporter = None
+    if not sharded:
+        cache = MetadataCache(options.cache) if options.cache else None
+        failed_log = FailedKeyLog(options.failed_log) if options.failed_log else None
+        reporter = instrumentation.StatsReporter(STATS, "set_s3_metadata", options.stats_interval,
+            options.stats_file, options.prometheus_textfile)
+    try:
+        if options.retry_failed:
+            for bucket_name, pages in _failed_key_pages(options.retry_failed).items():
+                update_metadata(s3, bucket_name, pages, values_to_set, threads, cache=cache,
+                    preserve=options.preserve, failed_log=failed_log)
+            return
 
-        if not bucket_pages:
-            logging.error("Failed to list bucket")
+        if sharded:
+            if len(args) != 1:
+                logging.error("Sharding requires exactly one s3:// prefix")
+                sys.exit(-1)
+            url_parts = urlparse(args[0])
+            kwargs = dict(cache_path=options.cache, preserve=options.preserve,
+                checkpoint_template=options.checkpoint or DEFAULT_SHARD_CHECKPOINT,
+                failed_log_path=options.failed_log, stats_interval=options.stats_interval,
+                stats_file=options.stats_file, prometheus_textfile=options.prometheus_textfile)
+            if options.processes:
+                ## local process j runs global shard shard * P + j of N * P
+                processes = options.processes
+                run_shards_locally(url_parts.netloc, url_parts.path.lstrip("/"),
+                    [shard * processes + j for j in range(processes)], shard_count * processes,
+                    values_to_set, threads, **kwargs)
+            else:
+                run_shard(url_parts.netloc, url_parts.path.lstrip("/"), shard, shard_count,
+                    values_to_set, threads, **kwargs)
             return
 
-        last_page = None
-        try: 
-            logging.info("Processing files...")
-            pool = ThreadPoolExecutor(max_workers=options.threads)
-            progress = tqdm(unit='files')
-            total_files = 0
-            for page in bucket_pages:
-                last_page = page
-                total_files += len(page['Contents'])
-                _fs = [pool.submit(replace_metadata, bucket_name, obj['Key'], values_to_set) for obj in page['Contents']]
-                wait(_fs)
-                progress.update(len(page['Contents']))
-
-        except KeyboardInterrupt as e:
-            _exit_gracefully(last_page)
-            raise e
+        checkpoint = options.checkpoint or _default_checkpoint_path()
+        resume_point = None
+        if options.resume:
+            with open(options.resume, 'rb') as f:
+                resume_point = pickle.load(f)
+            ## args are listed in order, so the checkpoint belongs to the first that matches
+            for i, arg in enumerate(args):
+                url_parts = urlparse(arg)
+                try:
+                    _check_resume_point(resume_point, url_parts.netloc, url_parts.path.strip("/"))
+                except ValueError:
+                    continue
+                args = args[i:]
+                break
+            else:
+                logging.error(f"{options.resume} does not match any of the given prefixes")
+                sys.exit(-1)
+        for arg in args:
+            url_parts = urlparse(arg)
+            bucket_name = url_parts.netloc
+
+            s3_prefix = url_parts.path.strip("/")
+            bucket_paginator = s3.get_paginator('list_objects_v2')
+            
+            # resume from file if given
+            pag_opts = {}
+            if resume_point is not None:
+                token = resume_point.get('NextContinuationToken')
+                resume_point = None
+                if token is None:
+                    ## the checkpointed page was the last one for this prefix
+                    logging.info(f"{arg} was already finished")
+                    continue
+                pag_opts = {"StartingToken": token}
+
+            bucket_pages = bucket_paginator.paginate(Bucket=bucket_name, Prefix=s3_prefix, PaginationConfig=pag_opts)
+
+            if not bucket_pages:
+                logging.error("Failed to list bucket")
+                return
 
+            update_metadata(s3, bucket_name, bucket_pages, values_to_set, threads, cache=cache,
+                preserve=options.preserve, checkpoint=checkpoint, failed_log=failed_log)
+        ## finished, so there is nothing left to resume
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+    finally:
+        if reporter is not None:
+            reporter.stop()
+        if cache is not None:
+            cache.close()
+        if failed_log is not None:
+            failed_log.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Bounded-memory field statistics.
+#
+# HyperLogLog estimates distinct counts in 2^precision
+# bytes; TopK keeps heavy hitters in a fixed number of
+# counters (weighted Misra-Gries); QuantileSample keeps a
+# fixed-size uniform sample for min/max/quantiles.
+#
+# Values are hashed with blake2b rather than hash(), so
+# estimates are the same from run to run and summaries of
+# two data releases can be diffed. Each sketch can merge
+# another of the same kind, so chunks of one input can be
+# summarized in separate processes.
+#-------------------------------------------------------
+import hashlib
+import heapq
+import math
+import random
+from collections import Counter
+
+DEFAULT_PRECISION = 14
+DEFAULT_TOP_K = 20
+DEFAULT_SAMPLE_SIZE = 10000
+QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+
+def _hash64(value):
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+class HyperLogLog(object):
+    """Distinct count estimate with a standard error of about 1.04/sqrt(2^precision)."""
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def update(self, values):
+        registers = self.registers
+        shift = 64 - self.precision
+        mask = (1 << shift) - 1
+        for value in values:
+            h = _hash64(value)
+            index = h >> shift
+            ## rank of the first 1 bit in the remaining bits
+            rank = shift - (h & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            ## linear counting is more accurate for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+
+class TopK(object):
+    """
+    Heavy hitters with weighted Misra-Gries counters. Counts are
+    underestimates by at most total / (capacity + 1).
+    """
+    def __init__(self, k=DEFAULT_TOP_K, capacity=None):
+        self.k = k
+        self.capacity = capacity or k * 10
+        self.counters = {}
+
+    def update(self, counts):
+        counters = self.counters
+        for value, count in counts.items():
+            counters[value] = counters.get(value, 0) + count
+        if len(counters) > self.capacity:
+            floor = heapq.nlargest(self.capacity + 1, counters.values())[-1]
+            self.counters = dict((v, c - floor) for v, c in counters.items() if c > floor)
+
+    def merge(self, other):
+        self.update(other.counters)
+
+    def most_common(self):
+        return heapq.nlargest(self.k, self.counters.items(), key=lambda item: item[1])
+
+
+class QuantileSample(object):
+    """
+    Uniform sample of at most size values, kept as the values with the
+    smallest random keys, plus exact count, min, max and sum.
+    """
+    def __init__(self, size=DEFAULT_SAMPLE_SIZE, seed=0):
+        self.size = size
+        self._random = random.Random(seed)
+        self._sample = []
+        self.count = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+        self.total = 0
+
+    def update(self, values):
+        present = [value for value in values if value is not None]
+        self.nulls += len(values) - len(present)
+        values = present
+        if not values:
+            return
+        self.count += len(values)
+        low, high = min(values), max(values)
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.total += sum(values)
+        rand = self._random.random
+        keyed = [(rand(), value) for value in values]
+        self._sample = heapq.nsmallest(self.size, self._sample + keyed)
+
+    def merge(self, other):
+        """Merge a sample of other values; the two should use different seeds."""
+        self.nulls += other.nulls
+        if not other.count:
+            return
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.total += other.total
+        self._sample = heapq.nsmallest(self.size, self._sample + other._sample)
+
+    def quantiles(self, qs=QUANTILES):
+        values = sorted(value for _, value in self._sample)
+        if not values:
+            return {}
+        return dict((q, values[min(len(values) - 1, int(q * len(values)))]) for q in qs)
+
+    def summary(self):
+        return {"count": self.count, "nulls": self.nulls, "min": self.min, "max": self.max,
+            "mean": self.total / self.count if self.count else None,
+            "quantiles": dict(("%g" % q, v) for q, v in self.quantiles().items()),
+            "exact": self.count <= self.size}
+
+
+class ExactCounts(object):
+    """Exact value counts, for fields where memory is not a concern."""
+    approximate = False
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def update(self, counts):
+        self.counts.update(counts)
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+
+    def summary(self):
+        counts = dict(self.counts)
+        nulls = counts.pop(None, 0)
+        return {"count": sum(counts.values()), "nulls": nulls, "distinct": len(counts),
+            "values": counts}
+
+
+class StringSketch(object):
+    """Approximate distinct count and top values of a field."""
+    approximate = True
+
+    def __init__(self, precision=DEFAULT_PRECISION, k=DEFAULT_TOP_K):
+        self.hll = HyperLogLog(precision)
+        self.top = TopK(k)
+        self.count = 0
+        self.nulls = 0
+
+    def update(self, counts):
+        counts = Counter(counts)
+        self.nulls += counts.pop(None, 0)
+        self.count += sum(counts.values())
+        self.hll.update(counts.keys())
+        self.top.update(counts)
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self.top.merge(other.top)
+        self.count += other.count
+        self.nulls += other.nulls
+
+    def summary(self):
+        return {"count": self.count, "nulls": self.nulls, "distinct": self.hll.count(),
+            "top": self.top.most_common()}
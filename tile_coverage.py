@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+#-------------------------------------------------------
+# Computes the set of tiles covering GeoJSON geometries.
+#
+# Tiles are found top-down: a tile is either outside the
+# geometry, fully inside a polygon, or on its boundary.
+# Only boundary tiles are subdivided and tested at the
+# next zoom, and each one only tests the edges that touch
+# its parent, so high zooms never test every tile in the
+# bounding box. Tiles fully inside a polygon are expanded
+# to their descendants without further tests.
+#
+# Coordinates may run past +/-180 (e.g. 170..190) for
+# regions that cross the antimeridian.
+#-------------------------------------------------------
+import json
+import logging
+from optparse import OptionParser
+
+import mercantile
+
+OUTSIDE, INSIDE, PARTIAL = 0, 1, 2
+
+MAX_LAT = 85.0511287798066
+
+
+def _geometries(obj):
+    """Yield the bare geometries in a GeoJSON object."""
+    kind = obj.get("type")
+    if kind == "FeatureCollection":
+        for feature in obj["features"]:
+            for geometry in _geometries(feature):
+                yield geometry
+    elif kind == "Feature":
+        if obj.get("geometry"):
+            for geometry in _geometries(obj["geometry"]):
+                yield geometry
+    elif kind == "GeometryCollection":
+        for child in obj["geometries"]:
+            for geometry in _geometries(child):
+                yield geometry
+    else:
+        yield obj
+
+
+def load_geojson(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Coverage(object):
+    """
+    Tile coverage of a GeoJSON object (FeatureCollection, Feature or
+    geometry). Polygon interiors are covered; line and point geometries
+    only cover the tiles they touch.
+    """
+    def __init__(self, geojson):
+        ## Each edge is (x0, y0, x1, y1, ring_owner). ring_owner is the
+        ## index of the polygon the edge bounds, or None for lines/points
+        ## which do not enclose an area.
+        self.edges = []
+        self.polygon_count = 0
+        for geometry in _geometries(geojson):
+            self._add_geometry(geometry)
+        if not self.edges:
+            raise ValueError("GeoJSON contains no geometries")
+
+        xs = [e[0] for e in self.edges] + [e[2] for e in self.edges]
+        ys = [e[1] for e in self.edges] + [e[3] for e in self.edges]
+        self.bounds = (min(xs), max(min(ys), -MAX_LAT), max(xs), min(max(ys), MAX_LAT))
+
+        ## Tiles are tested at their own longitude and, for geometries that
+        ## run past the antimeridian, shifted by a whole turn.
+        self.offsets = [0]
+        if self.bounds[2] > 180:
+            self.offsets.append(360)
+        if self.bounds[0] < -180:
+            self.offsets.append(-360)
+
+        self._build_bins()
+
+    def _add_geometry(self, geometry):
+        kind = geometry["type"]
+        coords = geometry["coordinates"]
+        if kind == "Polygon":
+            self._add_polygon(coords)
+        elif kind == "MultiPolygon":
+            for polygon in coords:
+                self._add_polygon(polygon)
+        elif kind == "LineString":
+            self._add_line(coords)
+        elif kind == "MultiLineString":
+            for line in coords:
+                self._add_line(line)
+        elif kind == "Point":
+            self._add_line([coords, coords])
+        elif kind == "MultiPoint":
+            for point in coords:
+                self._add_line([point, point])
+        else:
+            raise ValueError("Unsupported geometry type: %s" % kind)
+
+    def _add_polygon(self, rings):
+        owner = self.polygon_count
+        self.polygon_count += 1
+        for ring in rings:
+            points = list(ring)
+            if points and points[0] != points[-1]:
+                points.append(points[0])
+            self._add_line(points, owner)
+
+    def _add_line(self, points, owner=None):
+        for a, b in zip(points, points[1:]):
+            self.edges.append((a[0], a[1], b[0], b[1], owner))
+        if len(points) == 1:
+            self.edges.append((points[0][0], points[0][1], points[0][0], points[0][1], owner))
+
+    def _build_bins(self):
+        """
+        Bucket polygon edges into latitude bands so point-in-polygon tests
+        only look at edges that can cross a horizontal ray.
+        """
+        polygon_edges = [e for e in self.edges if e[4] is not None]
+        self._bin_count = max(1, min(4096, len(polygon_edges) // 4))
+        self._bin_south = min([min(e[1], e[3]) for e in polygon_edges] or [0])
+        north = max([max(e[1], e[3]) for e in polygon_edges] or [0])
+        self._bin_height = max((north - self._bin_south) / self._bin_count, 1e-12)
+        self._bins = [[] for _ in range(self._bin_count)]
+        for edge in polygon_edges:
+            first = self._bin(min(edge[1], edge[3]))
+            last = self._bin(max(edge[1], edge[3]))
+            for i in range(first, last + 1):
+                self._bins[i].append(edge)
+
+    def _bin(self, y):
+        i = int((y - self._bin_south) / self._bin_height)
+        return min(max(i, 0), self._bin_count - 1)
+
+    def _inside(self, px, py):
+        """Even-odd point-in-polygon test, true if inside any polygon."""
+        parity = {}
+        for x0, y0, x1, y1, owner in self._bins[self._bin(py)]:
+            if (y0 > py) != (y1 > py) and px < x0 + (py - y0) * (x1 - x0) / (y1 - y0):
+                parity[owner] = not parity.get(owner, False)
+        return any(parity.values())
+
+    def _classify(self, tile, edges):
+        """
+        Classify tile against the geometry, returning the status and the
+        subset of edges that touch it.
+        """
+        b = mercantile.bounds(tile)
+        status = OUTSIDE
+        touching = []
+        for offset in self.offsets:
+            w, s, e, n = b.west + offset, b.south, b.east + offset, b.north
+            hits = [edge for edge in edges if _segment_intersects_box(edge, w, s, e, n)]
+            if hits:
+                touching.extend(hits)
+                status = PARTIAL
+            elif status == OUTSIDE and self.polygon_count and \
+                    self._inside((w + e) / 2.0, (s + n) / 2.0):
+                status = INSIDE
+        return status, touching
+
+    def tiles(self, minzoom, maxzoom):
+        """
+        Yield every tile covering the geometry, zoom by zoom from minzoom to
+        maxzoom, without materializing the interior tiles.
+        """
+        ## Tiles fully inside a polygon, at the zoom they were found.
+        inside = []
+        ## Boundary tiles at the current zoom with the edges touching them.
+        partial = [(mercantile.Tile(0, 0, 0), self.edges)]
+
+        for zoom in range(0, maxzoom + 1):
+            if zoom > 0:
+                next_partial = []
+                for tile, edges in partial:
+                    for child in mercantile.children(tile):
+                        status, touching = self._classify(child, edges)
+                        if status == PARTIAL:
+                            next_partial.append((child, touching))
+                        elif status == INSIDE:
+                            inside.append(child)
+                partial = next_partial
+            else:
+                status, touching = self._classify(partial[0][0], self.edges)
+                if status == INSIDE:
+                    inside, partial = [partial[0][0]], []
+                elif status == OUTSIDE:
+                    partial = []
+
+            if zoom < minzoom:
+                continue
+            logging.info("Tiles for zoom %d: %d boundary, %d interior blocks" % (
+                zoom, len(partial), len(inside)))
+            for block in inside:
+                scale = 2 ** (zoom - block.z)
+                for x in range(block.x * scale, (block.x + 1) * scale):
+                    for y in range(block.y * scale, (block.y + 1) * scale):
+                        yield mercantile.Tile(x, y, zoom)
+            for tile, _ in partial:
+                yield tile
+
+
+def _segment_intersects_box(edge, w, s, e, n):
+    """
+    Liang-Barsky test for a segment touching the box w,s,e,n. Polygon edges
+    must pass through the box interior; an edge lying along the box
+    boundary leaves the tile to the point-in-polygon test, so neighbours of
+    a tile-aligned polygon are not pulled in.
+    """
+    x0, y0, x1, y1 = edge[0], edge[1], edge[2], edge[3]
+    if max(x0, x1) < w or min(x0, x1) > e or max(y0, y1) < s or min(y0, y1) > n:
+        return False
+    dx = x1 - x0
+    dy = y1 - y0
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x0 - w), (dx, e - x0), (-dy, y0 - s), (dy, n - y0)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                if t > t1:
+                    return False
+                t0 = max(t0, t)
+            else:
+                if t < t0:
+                    return False
+                t1 = min(t1, t)
+    if edge[4] is None:
+        return True
+    mid = (t0 + t1) / 2.0
+    mx, my = x0 + mid * dx, y0 + mid * dy
+    return w < mx < e and s < my < n
+
+
+def _main():
+    usage = "usage: %prog [options] coverage.geojson"
+    parser = OptionParser(usage=usage,
+                          description="Print the z/x/y tiles covering a GeoJSON file")
+    parser.add_option("-d", "--debug", action="store_true", dest="debug",
+                      help="Turn on debug logging")
+    parser.add_option("-q", "--quiet", action="store_true", dest="quiet",
+                      help="turn off all logging")
+    parser.add_option("-z", "--min-zoom", action="store", type="int",
+        dest="min_zoom", default=0)
+    parser.add_option("-Z", "--max-zoom", action="store", type="int",
+        dest="max_zoom", default=15)
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else
+    (logging.ERROR if options.quiet else logging.INFO))
+
+    cover = Coverage(load_geojson(args[0]))
+    for tile in cover.tiles(options.min_zoom, options.max_zoom):
+        print("%d/%d/%d" % (tile.z, tile.x, tile.y))
+
+if __name__ == "__main__":
+    _main()
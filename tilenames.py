@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #-------------------------------------------------------
 # Translates between lat/long and the slippy-map tile
 # numbering scheme
@@ -11,6 +11,12 @@
 from math import *
 from optparse import OptionParser
 import json
+import sys
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 def numTiles(z):
   return(pow(2,z))
@@ -66,28 +72,296 @@ def mercatorToLat(mercatorY):
 def tileSizePixels():
   return(256)
 
+def tile2quadkey(x,y,z):
+  digits = []
+  for i in range(z, 0, -1):
+    mask = 1 << (i - 1)
+    digit = 0
+    if x & mask:
+      digit += 1
+    if y & mask:
+      digit += 2
+    digits.append(str(digit))
+  return("".join(digits))
+
+def quadkey2tile(quadkey):
+  x = y = 0
+  z = len(quadkey)
+  for i, digit in enumerate(quadkey):
+    mask = 1 << (z - i - 1)
+    if digit not in "0123":
+      raise ValueError("Invalid quadkey digit %r in %s" % (digit, quadkey))
+    digit = int(digit)
+    if digit & 1:
+      x |= mask
+    if digit & 2:
+      y |= mask
+  return(x,y,z)
+
+#-------------------------------------------------------
+# Array versions of the functions above. Each takes NumPy
+# arrays (or anything np.asarray accepts) and returns arrays
+# computed with the same formulas. NumPy and libm round
+# differently, so lat/lon edges can differ in the last bit;
+# tile numbers that close to a tile boundary are recomputed
+# with the scalar formula, so tile numbers and quadkeys
+# match the scalar functions exactly. See
+# benchmarks/bench_tilenames.py.
+#-------------------------------------------------------
+def _require_numpy():
+  if np is None:
+    raise ImportError("numpy is required for the array tile functions")
+
+def latlon2relativeXYArray(lat,lon):
+  _require_numpy()
+  lat = np.radians(np.asarray(lat, dtype=np.float64))
+  lon = np.asarray(lon, dtype=np.float64)
+  x = (lon + 180) / 360
+  y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / pi) / 2
+  return(x,y)
+
+def latlon2xyArray(lat,lon,z):
+  n = numTiles(z)
+  x,y = latlon2relativeXYArray(lat,lon)
+  return(n*x, n*y)
+
+## Fractional tile coordinates this close to an integer, relative to the
+## number of tiles, are recomputed with tileXY
+BOUNDARY_TOLERANCE = 1e-12
+
+def tileXYArray(lat,lon,z):
+  """Return int64 arrays of tile x and y for arrays of lat and lon."""
+  x,y = latlon2xyArray(lat,lon,z)
+  ## int() truncates toward zero, so truncate rather than floor
+  x, y = np.broadcast_arrays(x, y)
+  shape = x.shape
+  x, y = x.reshape(-1), y.reshape(-1)
+  tx, ty = np.trunc(x).astype(np.int64), np.trunc(y).astype(np.int64)
+  ## the last bit can put a point on the other side of a tile edge
+  tolerance = BOUNDARY_TOLERANCE * numTiles(z) + 1e-9
+  near = np.nonzero((np.abs(x - np.round(x)) < tolerance) | (np.abs(y - np.round(y)) < tolerance))[0]
+  if len(near):
+    lat, lon = [np.broadcast_to(np.asarray(v, dtype=np.float64), shape).reshape(-1) for v in (lat, lon)]
+    for i in near.tolist():
+      tx[i], ty[i] = tileXY(float(lat[i]), float(lon[i]), z)
+  ## [()] gives a scalar back for scalar input
+  return(tx.reshape(shape)[()], ty.reshape(shape)[()])
+
+def mercatorToLatArray(mercatorY):
+  _require_numpy()
+  return(np.degrees(np.arctan(np.sinh(mercatorY))))
+
+def xy2latlonArray(x,y,z):
+  _require_numpy()
+  n = numTiles(z)
+  relY = np.asarray(y, dtype=np.float64) / n
+  lat = mercatorToLatArray(pi * (1 - 2 * relY))
+  lon = -180.0 + 360.0 * np.asarray(x, dtype=np.float64) / n
+  return(lat,lon)
+
+def latEdgesArray(y,z):
+  _require_numpy()
+  n = numTiles(z)
+  unit = 1 / n
+  relY1 = np.asarray(y, dtype=np.float64) * unit
+  relY2 = relY1 + unit
+  lat1 = mercatorToLatArray(pi * (1 - 2 * relY1))
+  lat2 = mercatorToLatArray(pi * (1 - 2 * relY2))
+  return(lat1,lat2)
+
+def lonEdgesArray(x,z):
+  _require_numpy()
+  n = numTiles(z)
+  unit = 360 / n
+  lon1 = -180 + np.asarray(x, dtype=np.float64) * unit
+  lon2 = lon1 + unit
+  return(lon1,lon2)
+
+def tileEdgesArray(x,y,z):
+  """Return (S, W, N, E) arrays of tile bounds."""
+  lat1,lat2 = latEdgesArray(y,z)
+  lon1,lon2 = lonEdgesArray(x,z)
+  return((lat2, lon1, lat1, lon2)) # S,W,N,E
+
+def tile2quadkeyArray(x,y,z):
+  """Return an array of quadkey strings (dtype S<z>) for tile arrays."""
+  _require_numpy()
+  x = np.asarray(x, dtype=np.int64)
+  y = np.asarray(y, dtype=np.int64)
+  if z == 0:
+    return(np.full(x.shape, b"", dtype="S1"))
+  shifts = np.arange(z - 1, -1, -1, dtype=np.int64)
+  digits = ((x[..., None] >> shifts) & 1) + 2 * ((y[..., None] >> shifts) & 1)
+  chars = (digits + ord("0")).astype(np.uint8)
+  return(np.ascontiguousarray(chars).view("S%d" % z).reshape(x.shape))
+
+def quadkey2tileArray(quadkeys):
+  """
+  Return (x, y, z) for an array of quadkeys that all have the same zoom.
+  """
+  _require_numpy()
+  quadkeys = np.asarray(quadkeys)
+  if quadkeys.dtype.kind == "U":
+    quadkeys = np.char.encode(quadkeys, "ascii")
+  z = quadkeys.dtype.itemsize
+  if quadkeys.size and np.any(np.char.str_len(quadkeys) != z):
+    raise ValueError("All quadkeys must have the same zoom")
+  digits = np.frombuffer(np.ascontiguousarray(quadkeys).tobytes(), dtype=np.uint8)
+  digits = digits.reshape(quadkeys.shape + (z,)).astype(np.int64) - ord("0")
+  if np.any((digits < 0) | (digits > 3)):
+    raise ValueError("Invalid quadkey digit")
+  shifts = np.arange(z - 1, -1, -1, dtype=np.int64)
+  x = ((digits & 1) << shifts).sum(axis=-1)
+  y = (((digits >> 1) & 1) << shifts).sum(axis=-1)
+  return(x, y, z)
+
+#-------------------------------------------------------
+# Point to tile aggregation
+#-------------------------------------------------------
+MAX_LAT = 85.0511287798066
+DEFAULT_CHUNK_SIZE = 100000
+
+def _parse_point(line, lonlat=False):
+  """
+  Parse a lat,lon CSV line (lon,lat if lonlat) or a GeoJSON Point feature.
+  Returns None for headers, blank lines and anything else unparseable.
+  """
+  line = line.strip()
+  if not line:
+    return None
+  if line[0] == "{":
+    try:
+      obj = json.loads(line.rstrip(","))
+      geometry = obj.get("geometry", obj)
+      if geometry.get("type") != "Point":
+        return None
+      lon, lat = geometry["coordinates"][:2]
+      return(float(lat), float(lon))
+    except (ValueError, KeyError, TypeError, AttributeError):
+      return None
+  parts = line.split(",")
+  try:
+    a, b = float(parts[0]), float(parts[1])
+  except (ValueError, IndexError):
+    return None
+  return((b, a) if lonlat else (a, b))
+
+def iter_point_chunks(lines, chunk_size=DEFAULT_CHUNK_SIZE, lonlat=False):
+  """Yield (lat, lon) arrays of at most chunk_size points read from lines."""
+  _require_numpy()
+  lats, lons = [], []
+  for line in lines:
+    point = _parse_point(line, lonlat)
+    if point is None:
+      continue
+    lats.append(point[0])
+    lons.append(point[1])
+    if len(lats) >= chunk_size:
+      yield(np.array(lats), np.array(lons))
+      lats, lons = [], []
+  if lats:
+    yield(np.array(lats), np.array(lons))
+
+def _merge_counts(keys, counts, new_keys, new_counts):
+  """
+  Add a chunk's sorted, unique tile keys and counts into the running sorted
+  keys and counts. Existing tiles are found by binary search rather than
+  re-sorting every tile seen so far.
+  """
+  pos = np.searchsorted(keys, new_keys)
+  found = pos < len(keys)
+  found[found] = keys[pos[found]] == new_keys[found]
+  counts[pos[found]] += new_counts[found]
+  missing = ~found
+  keys = np.insert(keys, pos[missing], new_keys[missing])
+  counts = np.insert(counts, pos[missing], new_counts[missing])
+  return(keys, counts)
+
+def count_points(chunks, minzoom, maxzoom):
+  """
+  Count points per tile from minzoom to maxzoom. Points are only binned at
+  maxzoom; memory is bounded by the number of occupied tiles, not points.
+  Lower zooms are rolled up from the zoom above by halving x and y.
+
+  Returns {zoom: (x, y, count)} arrays.
+  """
+  n = 1 << maxzoom
+  keys = np.zeros(0, dtype=np.int64)
+  counts = np.zeros(0, dtype=np.int64)
+  for lat, lon in chunks:
+    valid = (np.abs(lat) <= MAX_LAT) & (np.abs(lon) <= 180)
+    x, y = tileXYArray(lat[valid], lon[valid], maxzoom)
+    x = np.clip(x, 0, n - 1)
+    y = np.clip(y, 0, n - 1)
+    chunk_keys, chunk_counts = np.unique((x << maxzoom) | y, return_counts=True)
+    keys, counts = _merge_counts(keys, counts, chunk_keys, chunk_counts)
+
+  result = {}
+  x, y = keys >> maxzoom, keys & (n - 1)
+  for z in range(maxzoom, minzoom - 1, -1):
+    if z < maxzoom:
+      x, y = x >> 1, y >> 1
+      keys, inverse = np.unique((x << z) | y, return_inverse=True)
+      counts = np.bincount(inverse, weights=counts).astype(np.int64)
+      x, y = keys >> z, keys & ((1 << z) - 1)
+    result[z] = (x, y, counts)
+  return(result)
+
+def print_point_counts(tile_counts, min_count=1, flip_y=False, geojson=False):
+  """
+  Print "z/x/y count" lines, or a GeoJSON FeatureCollection of tile
+  polygons (one feature per line) that download_tiles.py --geojson accepts.
+  """
+  if geojson:
+    print('{"type": "FeatureCollection", "features": [')
+  first = True
+  for z in sorted(tile_counts):
+    x, y, counts = tile_counts[z]
+    keep = counts >= min_count
+    x, y, counts = x[keep], y[keep], counts[keep]
+    if geojson:
+      s, w, n, e = tileEdgesArray(x, y, z)
+    if flip_y:
+      y = (1 << z) - y - 1
+    for i in range(len(x)):
+      if not geojson:
+        print("%d/%d/%d %d" % (z, x[i], y[i], counts[i]))
+        continue
+      feature = {
+        "type": "Feature",
+        "properties": {"z": z, "x": int(x[i]), "y": int(y[i]), "count": int(counts[i])},
+        "geometry": {
+          "type": "Polygon",
+          "coordinates": [[[w[i],n[i]], [e[i],n[i]], [e[i],s[i]], [w[i],s[i]], [w[i],n[i]]]]
+        }
+      }
+      print(("" if first else ",") + json.dumps(feature))
+      first = False
+  if geojson:
+    print("]}")
+
 def print_pyramid(lat, lon, flip_y=False):
-  print "calculating tiles for point %f,%f" % (lat, lon)
+  print("calculating tiles for point %f,%f" % (lat, lon))
   for z in range(0,21):
     x,y = tileXY(lat, lon, z)
     s,w,n,e = tileEdges(x,y,z)
-    if options.flip_y:
+    if flip_y:
         y = (2 ** z) - y - 1
-    print "%d/%d/%d --> %1.5f,%1.5f,%1.5f,%1.5f - %1.5f*%1.5f" % (z,x,y, w,s,e,n, abs(w-e), abs(n-s))
+    print("%d/%d/%d --> %1.5f,%1.5f,%1.5f,%1.5f - %1.5f*%1.5f" % (z,x,y, w,s,e,n, abs(w-e), abs(n-s)))
 
 
 def print_bbox_pyramid(w, s, e, n, flip_y=False):
-  print "calculating tiles for bbox %f,%f,%f,%f" % (w, s, e, n)
+  print("calculating tiles for bbox %f,%f,%f,%f" % (w, s, e, n))
   for z in range(0,21):
     x1, y1 = tileXY(s, w, z)
     x2, y2 = tileXY(n, e, z)
 
-    if options.flip_y:
+    if flip_y:
         y1 = (2 ** z) - y1 - 1
         y2 = (2 ** z) - y2 - 1
         y1, y2 = y2, y1
 
-    print "z:%d x:%d-%d y:%d-%d  %d tiles" % (z, x1, x2, y2, y1, (x2 - x1 + 1) * (y1 - y2 + 1))
+    print("z:%d x:%d-%d y:%d-%d  %d tiles" % (z, x1, x2, y2, y1, (x2 - x1 + 1) * (y1 - y2 + 1)))
 
 
 if __name__ == "__main__":
@@ -99,10 +373,25 @@ if __name__ == "__main__":
     parser.add_option("-b", "--bbox", action="store", dest="bbox")
     parser.add_option("-y", "--flip-y", action="store_true", dest="flip_y", help="use TMS y origin, not OSM/google")
     parser.add_option("-g", "--geojson", action="store_true", dest="geojson", help="Only output geojson")
+    parser.add_option("-c", "--count-points", action="store_true", dest="count_points",
+        help="Count points read from stdin (lat,lon CSV or line-delimited GeoJSON) per tile")
+    parser.add_option("--lonlat", action="store_true", dest="lonlat",
+        help="CSV points are lon,lat rather than lat,lon")
+    parser.add_option("-z", "--min-zoom", action="store", type="int", dest="min_zoom", default=0)
+    parser.add_option("-Z", "--max-zoom", action="store", type="int", dest="max_zoom", default=15)
+    parser.add_option("--min-count", action="store", type="int", dest="min_count", default=1,
+        help="Only output tiles with at least this many points")
+    parser.add_option("--chunk-size", action="store", type="int", dest="chunk_size",
+        default=DEFAULT_CHUNK_SIZE, help="Points to read per chunk")
 
     (options, args) = parser.parse_args()
 
-    if options.latlon:
+    if options.count_points:
+        chunks = iter_point_chunks(sys.stdin, options.chunk_size, lonlat=options.lonlat)
+        tile_counts = count_points(chunks, options.min_zoom, options.max_zoom)
+        print_point_counts(tile_counts, min_count=options.min_count,
+          flip_y=options.flip_y, geojson=options.geojson)
+    elif options.latlon:
         lat, lon = options.latlon.split(',')
         print_pyramid(float(lat), float(lon), flip_y=options.flip_y)
     elif options.bbox:
@@ -126,9 +415,9 @@ if __name__ == "__main__":
             }
         }
         if options.geojson:
-          print json.dumps(geojson_feature)
+          print(json.dumps(geojson_feature))
         else:
-          print "%d/%d/%d --> sw:%1.5f,%1.5f, ne:%1.5f,%1.5f" % (z,x,y, s, w, n, e)
-          print "BBOX:  (%1.5f,%1.5f,%1.5f,%1.5f)" % (w, s, e, n)
-          print "Centroid: %1.5f, %1.5f" % ((w + e)/2.0, (n + s)/2.0)
-          print "Geojson: " + json.dumps(geojson_feature)
+          print("%d/%d/%d --> sw:%1.5f,%1.5f, ne:%1.5f,%1.5f" % (z,x,y, s, w, n, e))
+          print("BBOX:  (%1.5f,%1.5f,%1.5f,%1.5f)" % (w, s, e, n))
+          print("Centroid: %1.5f, %1.5f" % ((w + e)/2.0, (n + s)/2.0))
+          print("Geojson: " + json.dumps(geojson_feature))